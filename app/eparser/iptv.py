@@ -1,6 +1,10 @@
 """ Module for IPTV and streams support """
+import os
 import re
+import tempfile
+from collections import namedtuple
 from enum import Enum
+from itertools import chain
 from urllib.parse import unquote, quote
 
 from app.settings import SettingsType
@@ -21,56 +25,147 @@ class StreamType(Enum):
     E_SERVICE_URI = "8193"
 
 
+M3uEntry = namedtuple("M3uEntry", ["name", "url", "tvg_id", "logo", "group"])
+
+_EXTINF_ATTRS_PATTERN = re.compile(r'([\w-]+)="([^"]*)"')
+_ENIGMA2_URL_PATTERN = re.compile(".*:(http.*):.*")
+_NEUTRINO_URL_PATTERN = re.compile("(http.*?)::::.*")
+_BATCH_SIZE = 1000
+# Translation table for the quick quoting of the ASCII urls [the same result as urllib.parse.quote].
+_QUOTE_TABLE = {c: chr(c) if chr(c) in "_.-~/" or chr(c).isalnum() else "%{:02X}".format(c) for c in range(128)}
+
+
 def parse_m3u(path, s_type):
-    with open(path) as file:
-        aggr = [None] * 10
-        services = []
-        groups = set()
-        counter = 0
-        name = None
-
-        for line in file.readlines():
+    return list(chain.from_iterable(iter_m3u(path, s_type)))
+
+
+def iter_m3u(path, s_type, batch_size=_BATCH_SIZE):
+    """ Returns generator of the services lists (batches) from m3u file.
+
+        The file is read line by line. Group markers are created (Enigma2 only)
+        from the #EXTGRP lines or "group-title" attributes of the #EXTINF lines.
+    """
+    is_enigma = s_type is SettingsType.ENIGMA_2
+    if is_enigma:
+        fav_id_format = ENIGMA2_FAV_ID_FORMAT.format(StreamType.NONE_TS.value, 1, 0, 0, 0, 0, "{0}", "{1}", "{1}")
+    aggr = (None,) * 10
+    iptv_aggr = (None,) * 3 + (BqServiceType.IPTV.name,) + aggr
+    marker_aggr = (None,) * 3 + (BqServiceType.MARKER.name,) + aggr
+    groups = set()
+    services = []
+
+    for entry in iter_m3u_entries(path):
+        grp_name = entry.group
+        if is_enigma and grp_name and grp_name not in groups:
+            groups.add(grp_name)
+            fav_id = MARKER_FORMAT.format(len(groups) - 1, grp_name, grp_name)
+            services.append(Service._make((None, None, None, grp_name) + marker_aggr + (fav_id, None)))
+
+        if is_enigma:
+            fav_id = fav_id_format.format(quote_url(entry.url), entry.name)
+        else:
+            fav_id = NEUTRINO_FAV_ID_FORMAT.format(entry.url, "", 0, None, None, None, None, entry.logo or "", "", 1)
+        services.append(Service._make((None, None, IPTV_ICON, entry.name) + iptv_aggr + (fav_id, None)))
+
+        if len(services) >= batch_size:
+            yield services
+            services = []
+
+    if services:
+        yield services
+
+
+def iter_m3u_entries(path):
+    """ Returns generator of M3uEntry from m3u file.
+
+        Supported #EXTINF attributes: tvg-id, tvg-logo, group-title.
+    """
+    with open(path, encoding="utf-8", errors="replace") as file:
+        name, attrs, group = None, None, None
+
+        for line in file:
             if line.startswith("#EXTINF"):
-                name = line[1 + line.index(","):].strip()
-            elif line.startswith("#EXTGRP") and s_type is SettingsType.ENIGMA_2:
-                grp_name = line.strip("#EXTGRP:").strip()
-                if grp_name not in groups:
-                    groups.add(grp_name)
-                    fav_id = MARKER_FORMAT.format(counter, grp_name, grp_name)
-                    counter += 1
-                    mr = Service(None, None, None, grp_name, *aggr[0:3], BqServiceType.MARKER.name, *aggr, fav_id, None)
-                    services.append(mr)
+                info, sep, name = line.partition(",")
+                name = name.strip()
+                attrs = dict(_EXTINF_ATTRS_PATTERN.findall(info)) if "=" in info else None
+                if attrs and attrs.get("group-title", None):
+                    group = attrs.get("group-title").strip()
+            elif line.startswith("#EXTGRP"):
+                group = line.partition(":")[2].strip()
             elif not line.startswith("#"):
                 url = line.strip()
-                fav_id = get_fav_id(url, name, s_type)
                 if name and url:
-                    srv = Service(None, None, IPTV_ICON, name, *aggr[0:3], BqServiceType.IPTV.name, *aggr, fav_id, None)
-                    services.append(srv)
+                    yield M3uEntry(name, url, attrs.get("tvg-id", None) if attrs else None,
+                                   attrs.get("tvg-logo", None) if attrs else None, group)
+                name, attrs = None, None
 
-    return services
+
+def quote_url(url):
+    try:
+        url.encode("ascii")
+    except UnicodeEncodeError:
+        return quote(url)
+    return url.translate(_QUOTE_TABLE)
 
 
 def export_to_m3u(path, bouquet, s_type):
-    pattern = re.compile(".*:(http.*):.*") if s_type is SettingsType.ENIGMA_2 else re.compile("(http.*?)::::.*")
-    lines = ["#EXTM3U\n"]
-    current_grp = None
+    write_m3u(path + "{}.m3u".format(bouquet.name), chain(("#EXTM3U\n",), get_m3u_lines(bouquet, s_type)))
+
+
+def export_all_to_m3u(path, bouquets, s_type, merge=False, name="all"):
+    """ Exports IPTV services of the bouquets to m3u files.
+
+        If [merge] is True, all bouquets are saved in one [name].m3u file.
+        The bouquet (or marker) names are used as group-title in this case.
+        Returns the number of saved files.
+    """
+    if merge:
+        lines = chain.from_iterable(get_m3u_lines(bq, s_type, True) for bq in bouquets)
+        write_m3u(path + "{}.m3u".format(name), chain(("#EXTM3U\n",), lines))
+        return 1
+
+    count = 0
+    for bq in bouquets:
+        export_to_m3u(path, bq, s_type)
+        count += 1
+    return count
+
+
+def get_m3u_lines(bouquet, s_type, use_group_title=False):
+    """ Returns generator of the m3u lines for IPTV services of the bouquet. """
+    match = _ENIGMA2_URL_PATTERN.match if s_type is SettingsType.ENIGMA_2 else _NEUTRINO_URL_PATTERN.match
+    iptv, marker = BqServiceType.IPTV, BqServiceType.MARKER
+    current_grp = bouquet.name if use_group_title else None
 
     for s in bouquet.services:
         s_type = s.type
-        if s_type is BqServiceType.IPTV:
-            res = re.match(pattern, s.data)
+        if s_type is iptv:
+            res = match(s.data)
             if not res:
                 continue
-            data = res.group(1)
-            lines.append("#EXTINF:-1,{}\n".format(s.name))
-            if current_grp:
-                lines.append(current_grp)
-            lines.append("{}\n".format(unquote(data.strip())))
-        elif s_type is BqServiceType.MARKER:
-            current_grp = "#EXTGRP:{}\n".format(s.name)
-
-    with open(path + "{}.m3u".format(bouquet.name), "w", encoding="utf-8") as file:
-        file.writelines(lines)
+            if use_group_title:
+                yield '#EXTINF:-1 group-title="{}",{}\n'.format(current_grp.replace('"', "'"), s.name)
+            else:
+                yield "#EXTINF:-1,{}\n".format(s.name)
+                if current_grp:
+                    yield current_grp
+            yield "{}\n".format(unquote(res.group(1).strip()))
+        elif s_type is marker:
+            current_grp = s.name if use_group_title else "#EXTGRP:{}\n".format(s.name)
+
+
+def write_m3u(path, lines):
+    """ Writes the lines to the file atomically [via a temporary file in the same directory]. """
+    with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(path) or None,
+                                     suffix=".m3u", delete=False) as f:
+        try:
+            f.writelines(lines)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+
+    os.replace(f.name, path)
 
 
 def get_fav_id(url, service_name, s_type):
@@ -1,10 +1,121 @@
 """  Module for working with epg.dat file """
+import calendar
+import os
 import struct
+import tempfile
+from array import array
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
 from xml.dom.minidom import parse, Node, Document
+from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import escape, quoteattr
 
 from app.eparser.ecommons import BqServiceType, BouquetService
 
+_EPG_MAGIC = 0x98765432
+_EPG_HEADER = "ENIGMA_EPG_V7"
+_EPG_EVENT_TYPE = 0
+# Offset of the Modified Julian Date for 01.01.1970.
+_MJD_UNIX_EPOCH = 40587
+_SHORT_EVENT_DESCRIPTOR = 0x4D
+_EXTENDED_EVENT_DESCRIPTOR = 0x4E
+_UTF8_CHARSET = b"\x15"
+_DEFAULT_LANG = "eng"
+# Number of decoded descriptors kept in memory during conversion.
+_DESCRIPTORS_CACHE_SIZE = 4096
+_XMLTV_TIME_FORMAT = "%Y%m%d%H%M%S +0000"
+# DVB control codes [0x8A - CR/LF, 0x86, 0x87 - emphasis on/off] and chars not allowed in XML.
+_CONTROL_CHARS = {**dict.fromkeys(c for c in range(0x20) if c not in (0x09, 0x0A, 0x0D)),
+                  0x86: None, 0x87: None, 0x8A: "\n"}
+# Character tables (ETSI EN 300 468, Annex A).
+_CHARSETS = {0x01: "iso-8859-5", 0x02: "iso-8859-6", 0x03: "iso-8859-7", 0x04: "iso-8859-8", 0x05: "iso-8859-9",
+             0x06: "iso-8859-10", 0x07: "iso-8859-11", 0x09: "iso-8859-13", 0x0A: "iso-8859-14",
+             0x0B: "iso-8859-15", 0x11: "utf-16-be", 0x13: "gb2312", 0x14: "big5", 0x15: "utf-8"}
+
+EpgEvent = namedtuple("EpgEvent", ["event_id", "start", "duration", "title", "short_desc", "description", "lang"])
+
+
+def _get_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for j in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _get_crc_table()
+
+
+def get_descriptor_crc(data):
+    """ Returns the crc of the descriptor in the same way as the eventData of the Enigma2 does. """
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) ^ _CRC_TABLE[((crc >> 24) ^ b) & 0xFF]) & 0xFFFFFFFF
+    return crc
+
+
+def decode_text(data):
+    """ Decodes DVB string with the optional character table prefix. """
+    if not data:
+        return ""
+
+    charset, first = "iso-8859-1", data[0]
+    if first == 0x10 and len(data) > 2:
+        charset, data = "iso-8859-{}".format(data[2]), data[3:]
+    elif first < 0x20:
+        charset, data = _CHARSETS.get(first, charset), data[1:]
+
+    try:
+        text = data.decode(charset, errors="ignore")
+    except LookupError:
+        text = data.decode("iso-8859-1", errors="ignore")
+    return text.translate(_CONTROL_CHARS)
+
+
+def encode_text(text, limit):
+    """ Returns DVB (UTF-8) string not longer than limit bytes. """
+    return next(split_text(text, limit - 1), b"") if limit > 1 else b""
+
+
+def split_text(text, size):
+    """ Splits text into DVB (UTF-8) strings with size (without the charset prefix) not exceeding the given one. """
+    data = (text or "").encode("utf-8")
+    while data:
+        chunk = data[:size].decode("utf-8", errors="ignore").encode("utf-8")
+        if not chunk:
+            break
+        yield _UTF8_CHARSET + chunk
+        data = data[len(chunk):]
+
+
+def _from_bcd(value):
+    return (value >> 4) * 10 + (value & 0x0F)
+
+
+def _to_bcd(value):
+    return ((value // 10) << 4) | (value % 10)
+
+
+def decode_eit_data(data):
+    """ Returns event id, start time (UTC timestamp) and duration (sec) from the first 10 bytes of the EIT event. """
+    event_id, mjd, h, m, s, dh, dm, ds = struct.unpack(">HHBBBBBB", data)
+    start = (mjd - _MJD_UNIX_EPOCH) * 86400 + _from_bcd(h) * 3600 + _from_bcd(m) * 60 + _from_bcd(s)
+    return event_id, start, _from_bcd(dh) * 3600 + _from_bcd(dm) * 60 + _from_bcd(ds)
+
+
+def encode_eit_data(event_id, start, duration):
+    days, sec = divmod(int(start), 86400)
+    h, sec = divmod(sec, 3600)
+    m, s = divmod(sec, 60)
+    duration = min(int(duration), 99 * 3600 + 3599)
+    dh, duration = divmod(duration, 3600)
+    dm, ds = divmod(duration, 60)
+    return struct.pack(">HHBBBBBB", event_id & 0xFFFF, days + _MJD_UNIX_EPOCH,
+                       *map(_to_bcd, (h, m, s, dh, dm, ds)))
+
 
 class EPG:
 
@@ -13,33 +124,308 @@ class EPG:
         """ The read algorithm was taken from the eEPGCache::load() function from this source:
             https://github.com/OpenPLi/enigma2/blob/44d9b92f5260c7de1b3b3a1b9a9cbe0f70ca4bf0/lib/dvb/epgcache.cpp#L1300
         """
-        refs = set()
+        return {service_id for service_id, events_size in EPG.get_channels(path)}
 
+    @staticmethod
+    def get_channels(path):
+        """ Returns generator of (service id, events count) in the order of the epg.dat file. """
         with open(path, mode="rb") as f:
-            crc = struct.unpack("<I", f.read(4))[0]
-            if crc != int(0x98765432):
-                raise ValueError("Epg file has incorrect byte order!")
-
-            header = f.read(13).decode()
-            if header != "ENIGMA_EPG_V7":
-                raise ValueError("Unsupported format of epd.dat file!")
+            for i in range(EPG.read_header(f)):
+                service_id, events_size = EPG.read_channel(f)
+                EPG.skip_events(f, events_size)
+                yield service_id, events_size
 
-            channels_count = struct.unpack("<I", f.read(4))[0]
+    @staticmethod
+    def get_events(path):
+        """ Returns generator of (service id, EpgEvent) from the epg.dat file.
 
+            The events are read one by one. Descriptors (stored at the end of the file)
+            are indexed only by their offsets and read on demand through a small cache,
+            so the memory usage does not depend on the size of the file.
+        """
+        with open(path, mode="rb") as f, open(path, mode="rb") as df:
+            channels_count = EPG.read_header(f)
+            start = f.tell()
             for i in range(channels_count):
-                sid, nid, tsid, events_size = struct.unpack("<IIII", f.read(16))
-                service_id = "{:X}:{:X}:{:X}".format(sid, tsid, nid)
+                EPG.skip_events(f, EPG.read_channel(f)[1])
+            offsets = EPG.read_descriptors_index(f)
+            f.seek(start)
+
+            @lru_cache(maxsize=_DESCRIPTORS_CACHE_SIZE)
+            def get_descriptor(crc):
+                offset = offsets.get(crc, None)
+                if offset is not None:
+                    df.seek(offset)
+                    tag, d_len = struct.unpack("<BB", df.read(2))
+                    return tag, df.read(d_len)
 
+            for i in range(channels_count):
+                service_id, events_size = EPG.read_channel(f)
                 for j in range(events_size):
                     _type, _len = struct.unpack("<BB", f.read(2))
-                    f.read(10)
+                    eit_data = f.read(10)
                     n_crc = (_len - 10) // 4
-                    if n_crc > 0:
-                        [f.read(4) for n in range(n_crc)]
+                    crcs = struct.unpack("<{}I".format(n_crc), f.read(4 * n_crc)) if n_crc > 0 else ()
+                    yield service_id, EPG.get_event(eit_data, filter(None, map(get_descriptor, crcs)))
+
+    @staticmethod
+    def write_events(path, events):
+        """ Writes events [(service id, EpgEvent), ...] to the epg.dat file.
+
+            Events don't have to be grouped by the channel. Encoded events and descriptors
+            are spooled to the temporary files and only their offsets are kept in memory.
+            The resulting file replaces the old one only after successful writing.
+        """
+        channels = {}  # (sid, nid, tsid) -> [offsets, sizes, next event id]
+        descriptors = {}  # crc -> [ref count, offset, size]
+
+        with tempfile.TemporaryFile() as ev_spool, tempfile.TemporaryFile() as ds_spool:
+            for service_id, event in events:
+                key = EPG.get_channel_key(service_id)
+                if not key:
+                    continue
+
+                crcs = []
+                for data in EPG.get_event_descriptors(event):
+                    crc = get_descriptor_crc(data)
+                    descriptor = descriptors.get(crc, None)
+                    if descriptor:
+                        descriptor[0] += 1
+                    else:
+                        descriptors[crc] = [1, ds_spool.tell(), len(data)]
+                        ds_spool.write(data)
+                    crcs.append(crc)
+
+                channel = channels.get(key, None)
+                if not channel:
+                    channel = [array("Q"), array("H"), 1]
+                    channels[key] = channel
+
+                event_id = channel[2] if event.event_id is None else event.event_id
+                channel[2] = event_id + 1
+                crcs = crcs[:61]  # Max length of the event data is 255 bytes.
+                record = b"".join((struct.pack("<BB", _EPG_EVENT_TYPE, 10 + 4 * len(crcs)),
+                                   encode_eit_data(event_id, event.start, event.duration),
+                                   struct.pack("<{}I".format(len(crcs)), *crcs)))
+                channel[0].append(ev_spool.tell())
+                channel[1].append(len(record))
+                ev_spool.write(record)
+
+            with tempfile.NamedTemporaryFile(mode="wb", dir=os.path.dirname(path) or None, delete=False) as f:
+                try:
+                    f.write(struct.pack("<I", _EPG_MAGIC))
+                    f.write(_EPG_HEADER.encode())
+                    f.write(struct.pack("<I", len(channels)))
+                    for (sid, nid, tsid), (offsets, sizes, ev_id) in channels.items():
+                        f.write(struct.pack("<IIII", sid, nid, tsid, len(offsets)))
+                        for offset, size in zip(offsets, sizes):
+                            ev_spool.seek(offset)
+                            f.write(ev_spool.read(size))
+
+                    f.write(struct.pack("<I", len(descriptors)))
+                    for crc, (ref, offset, size) in descriptors.items():
+                        ds_spool.seek(offset)
+                        f.write(struct.pack("<Ii", crc, ref))
+                        f.write(ds_spool.read(size))
+                except Exception:
+                    os.remove(f.name)
+                    raise
+
+            os.replace(f.name, path)
+
+    @staticmethod
+    def read_header(f):
+        """ Checks the header of the epg.dat file and returns count of the channels. """
+        crc = struct.unpack("<I", f.read(4))[0]
+        if crc != int(_EPG_MAGIC):
+            raise ValueError("Epg file has incorrect byte order!")
+
+        header = f.read(13).decode()
+        if header != _EPG_HEADER:
+            raise ValueError("Unsupported format of epd.dat file!")
+
+        return struct.unpack("<I", f.read(4))[0]
+
+    @staticmethod
+    def read_channel(f):
+        """ Returns service id and events count for the current channel. """
+        sid, nid, tsid, events_size = struct.unpack("<IIII", f.read(16))
+        return "{:X}:{:X}:{:X}".format(sid, tsid, nid), events_size
+
+    @staticmethod
+    def skip_events(f, events_size):
+        for j in range(events_size):
+            _type, _len = struct.unpack("<BB", f.read(2))
+            n_crc = (_len - 10) // 4
+            f.seek(10 + 4 * n_crc if n_crc > 0 else 10, os.SEEK_CUR)
+
+    @staticmethod
+    def read_descriptors_index(f):
+        """ Returns dict {crc: offset} for the descriptors section. """
+        offsets = {}
+        size = f.read(4)
+        if len(size) < 4:
+            return offsets
+
+        for i in range(struct.unpack("<I", size)[0]):
+            crc, ref, tag, d_len = struct.unpack("<IiBB", f.read(10))
+            offsets[crc] = f.tell() - 2
+            f.seek(d_len, os.SEEK_CUR)
+
+        return offsets
+
+    @staticmethod
+    def get_event(eit_data, descriptors):
+        event_id, start, duration = decode_eit_data(eit_data)
+        title, short_desc, lang = "", "", None
+        extended = []
+
+        for tag, data in descriptors:
+            if tag == _SHORT_EVENT_DESCRIPTOR and not title and len(data) > 4:
+                lang = data[:3].decode("ascii", errors="ignore")
+                n_len = data[3]
+                title = decode_text(data[4:4 + n_len]).strip()
+                t_len = data[4 + n_len] if len(data) > 4 + n_len else 0
+                short_desc = decode_text(data[5 + n_len:5 + n_len + t_len]).strip()
+            elif tag == _EXTENDED_EVENT_DESCRIPTOR and len(data) > 5:
+                pos = 5 + data[4]  # Skipping items
+                t_len = data[pos] if len(data) > pos else 0
+                extended.append((data[0] >> 4, decode_text(data[pos + 1:pos + 1 + t_len])))
+
+        description = "".join(t for n, t in sorted(extended)).strip()
+        return EpgEvent(event_id, start, duration, title, short_desc, description, lang)
+
+    @staticmethod
+    def get_event_descriptors(event):
+        """ Returns generator of short and extended event descriptors for the event. """
+        lang = (event.lang or _DEFAULT_LANG).encode("ascii", errors="ignore")[:3].ljust(3, b" ")
+        title = encode_text(event.title, 248)
+        text = encode_text(event.short_desc, 250 - len(title))
+        body = b"".join((lang, bytes((len(title),)), title, bytes((len(text),)), text))
+        yield bytes((_SHORT_EVENT_DESCRIPTOR, len(body))) + body
+
+        chunks = list(split_text(event.description, 248))[:16]
+        last = len(chunks) - 1
+        for num, chunk in enumerate(chunks):
+            body = b"".join((bytes((num << 4 | last,)), lang, b"\x00", bytes((len(chunk),)), chunk))
+            yield bytes((_EXTENDED_EVENT_DESCRIPTOR, len(body))) + body
+
+    @staticmethod
+    def get_channel_key(service_id):
+        """ Returns (sid, nid, tsid) from the service id [SID:TSID:NID] or None. """
+        try:
+            sid, tsid, nid = (int(v, 16) for v in service_id.split(":")[:3])
+        except (AttributeError, ValueError):
+            return None
+        return sid, nid, tsid
+
+
+class XmlTv:
+    """ Conversion between epg.dat and XMLTV formats. """
+
+    @staticmethod
+    def from_epg_dat(epg_path, xml_path, names=None):
+        """ Converts epg.dat to the XMLTV file.
+
+            @param names: optional dict {service id: display name} for the channel elements.
+        """
+        names = names or {}
+        channels = dict.fromkeys(s_id for s_id, ev_size in EPG.get_channels(epg_path) if ev_size)
+
+        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(xml_path) or None,
+                                         delete=False) as f:
+            try:
+                f.write('<?xml version="1.0" encoding="utf-8"?>\n<tv generator-info-name="DemonEditor">\n')
+                for s_id in channels:
+                    f.write("  <channel id={}>\n    <display-name>{}</display-name>\n  </channel>\n".format(
+                        quoteattr(s_id), escape(names.get(s_id, s_id))))
+
+                for s_id, event in EPG.get_events(epg_path):
+                    f.write(XmlTv.get_programme(s_id, event))
+                f.write("</tv>\n")
+            except Exception:
+                os.remove(f.name)
+                raise
+
+        os.replace(f.name, xml_path)
+
+    @staticmethod
+    def to_epg_dat(xml_path, epg_path, refs=None):
+        """ Converts XMLTV file to the epg.dat.
+
+            @param refs: optional dict {XMLTV channel id: service id [SID:TSID:NID]}.
+        """
+        EPG.write_events(epg_path, XmlTv.get_events(xml_path, refs))
+
+    @staticmethod
+    def get_events(xml_path, refs=None):
+        """ Returns generator of (service id, EpgEvent) from the XMLTV file.
+
+            Processed elements are removed from the tree, so the file is never fully loaded into memory.
+            Without refs, the channel id is used as service id.
+        """
+        root = None
+        for event, elem in iterparse(xml_path, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end":
+                continue
+
+            if elem.tag == "programme":
+                ch_id = elem.get("channel")
+                service_id = refs.get(ch_id, None) if refs else ch_id
+                start, stop = get_xmltv_time(elem.get("start")), get_xmltv_time(elem.get("stop"))
+                if service_id and start is not None:
+                    title = elem.find("title")
+                    lang = title.get("lang") if title is not None else None
+                    yield service_id, EpgEvent(None, start, max((stop or start) - start, 0),
+                                               XmlTv.get_text(title),
+                                               XmlTv.get_text(elem.find("sub-title")),
+                                               XmlTv.get_text(elem.find("desc")),
+                                               lang)
+                root.clear()
+            elif elem.tag == "channel":
+                root.clear()
+
+    @staticmethod
+    def get_programme(service_id, event):
+        lang = " lang={}".format(quoteattr(event.lang.strip())) if event.lang and event.lang.strip() else ""
+        lines = ["  <programme start=\"{}\" stop=\"{}\" channel={}>\n".format(
+            get_xmltv_time_str(event.start), get_xmltv_time_str(event.start + event.duration), quoteattr(service_id)),
+            "    <title{}>{}</title>\n".format(lang, escape(event.title))]
+        if event.short_desc:
+            lines.append("    <sub-title{}>{}</sub-title>\n".format(lang, escape(event.short_desc)))
+        if event.description:
+            lines.append("    <desc{}>{}</desc>\n".format(lang, escape(event.description)))
+        lines.append("  </programme>\n")
+
+        return "".join(lines)
+
+    @staticmethod
+    def get_text(elem):
+        return elem.text.strip() if elem is not None and elem.text else ""
+
+
+def get_xmltv_time(value):
+    """ Returns UTC timestamp from the XMLTV time string [YYYYmmddHHMMSS +HHMM]. """
+    if not value:
+        return None
+
+    value = value.strip()
+    try:
+        ts = calendar.timegm(datetime.strptime(value[:14], "%Y%m%d%H%M%S").timetuple())
+    except ValueError:
+        return None
+
+    tz = value[14:].strip()
+    if len(tz) == 5 and tz[0] in "+-" and tz[1:].isdigit():
+        offset = int(tz[1:3]) * 3600 + int(tz[3:]) * 60
+        ts = ts - offset if tz[0] == "+" else ts + offset
+    return ts
 
-                refs.add(service_id)
 
-        return refs
+def get_xmltv_time_str(ts):
+    return datetime.utcfromtimestamp(ts).strftime(_XMLTV_TIME_FORMAT)
 
 
 class ChannelsParser:
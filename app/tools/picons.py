@@ -1,17 +1,46 @@
+import concurrent.futures
+import fcntl
 import glob
+import hashlib
+import json
 import os
 import re
+import shlex
 import shutil
-
-from collections import namedtuple
+import tempfile
+import time
+from collections import namedtuple, defaultdict
+from enum import Enum
 from html.parser import HTMLParser
+from threading import Lock, BoundedSemaphore, Event
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urljoin
+from urllib.request import Request, urlopen
 
-from app.commons import run_task
-from app.settings import SettingsType
+from app.commons import run_task, log
+from app.settings import SettingsType, HOME_PATH
 
-_ENIGMA2_PICON_KEY = "{:X}:{:X}:{}"
 _NEUTRINO_PICON_KEY = "{:x}{:04x}{:04x}.png"
 
+CACHE_PATH = HOME_PATH + "/.cache/demon-editor/lyngsat/"
+_HEADERS = {"User-Agent": "Mozilla/5.0 (X11; Linux i586; rv:31.0) Gecko/20100101 Firefox/69.0",
+            "Accept": "*/*"}
+# Linux ioctl to clone the file data [reflink].
+_FICLONE = 0x40049409
+_COPY_WORKERS = 8
+_PROGRESS_STEP = 500
+
+
+class CopyMode(Enum):
+    """ File copying modes in the order of fallback.
+
+        Hard links are not used: the picons can be rewritten in place [e.g. on resizing],
+        which would change the source files too.
+    """
+    REFLINK = 0
+    COPY = 1
+
+
 Provider = namedtuple("Provider", ["logo", "name", "pos", "url", "on_id", "ssid", "single", "selected"])
 Picon = namedtuple("Picon", ["ref", "ssid", "v_pid"])
 
@@ -19,13 +48,14 @@ Picon = namedtuple("Picon", ["ref", "ssid", "v_pid"])
 class PiconsParser(HTMLParser):
     """ Parser for package html page. (https://www.lyngsat.com/packages/*provider-name*.html) """
 
-    def __init__(self, entities=False, separator=' ', single=None):
+    def __init__(self, entities=False, separator=' ', single=None, url=""):
 
         HTMLParser.__init__(self)
 
         self._parse_html_entities = entities
         self._separator = separator
         self._single = single
+        self._url = url
         self._is_td = False
         self._is_th = False
         self._current_row = []
@@ -38,7 +68,7 @@ class PiconsParser(HTMLParser):
         if tag == 'th':
             self._is_th = True
         if tag == "img":
-            self._current_row.append(attrs[0][1])
+            self._current_row.append(urljoin(self._url, dict(attrs).get("src", None) or ""))
 
     def handle_data(self, data):
         """ Save content to a cell """
@@ -59,14 +89,14 @@ class PiconsParser(HTMLParser):
             row = self._current_row
             ln = len(row)
 
-            if self._single and ln == 4 and row[0].startswith("../../logo/"):
-                self.picons.append(Picon(row[0].strip("../"), "0", "0"))
+            if self._single and ln == 4 and is_logo_url(row[0]):
+                self.picons.append(Picon(row[0], "0", "0"))
             else:
                 if 9 < ln < 13:
                     url = None
-                    if row[0].startswith("../logo/"):
+                    if is_logo_url(row[0]):
                         url = row[0]
-                    elif row[1].startswith("../logo/"):
+                    elif is_logo_url(row[1]):
                         url = row[1]
 
                     ssid = row[-4]
@@ -79,39 +109,40 @@ class PiconsParser(HTMLParser):
         pass
 
     @staticmethod
-    def parse(open_path, picons_path, tmp_path, provider, picon_ids, s_type=SettingsType.ENIGMA_2):
-        with open(open_path, encoding="utf-8", errors="replace") as f:
-            on_id, pos, ssid, single = provider.on_id, provider.pos, provider.ssid, provider.single
-            neg_pos = pos.endswith("W")
-            pos = int("".join(c for c in pos if c.isdigit()))
-            # For negative (West) positions 3600 - numeric position value!!!
-            if neg_pos:
-                pos = 3600 - pos
-            parser = PiconsParser(single=single)
-            parser.reset()
-            parser.feed(f.read())
-            picons = parser.picons
-            if picons:
-                os.makedirs(picons_path, exist_ok=True)
-                for p in picons:
-                    try:
-                        if single:
-                            on_id, freq = on_id.strip().split("::")
-                            namespace = "{:X}{:X}".format(int(pos), int(freq))
-                        else:
-                            namespace = "{:X}0000".format(int(pos))
-                        name = PiconsParser.format(ssid if single else p.ssid, on_id, namespace, picon_ids, s_type)
-                        p_name = picons_path + (name if name else os.path.basename(p.ref))
-                        shutil.copyfile(tmp_path + "www.lyngsat.com/" + p.ref.lstrip("."), p_name)
-                    except (TypeError, ValueError) as e:
-                        msg = "Picons format parse error: {}".format(p) + "\n" + str(e)
-                        # log(msg)
-                        print(msg)
+    def parse(html, provider, picon_ids, s_type=SettingsType.ENIGMA_2):
+        """ Parses the provider page [html text].
+
+            Returns a dict of the logos urls with the names of the picon files.
+        """
+        on_id, pos, ssid, single = provider.on_id, provider.pos, provider.ssid, provider.single
+        neg_pos = pos.endswith("W")
+        pos = int("".join(c for c in pos if c.isdigit()))
+        # For negative (West) positions 3600 - numeric position value!!!
+        if neg_pos:
+            pos = 3600 - pos
+        parser = PiconsParser(single=single, url=provider.url)
+        parser.reset()
+        parser.feed(html)
+        picons = {}
+
+        for p in parser.picons:
+            try:
+                if single:
+                    on_id, freq = on_id.strip().split("::")
+                    namespace = int("{:X}{:X}".format(int(pos), int(freq)), 16)
+                else:
+                    namespace = int(pos) << 16
+                name = PiconsParser.format(ssid if single else p.ssid, on_id, namespace, picon_ids, s_type)
+                picons[p.ref] = name if name else os.path.basename(urlsplit(p.ref).path)
+            except (TypeError, ValueError) as e:
+                log("Picons format parse error: {}\n{}".format(p, e))
+
+        return picons
 
     @staticmethod
     def format(ssid, on_id, namespace, picon_ids, s_type):
         if s_type is SettingsType.ENIGMA_2:
-            return picon_ids.get(_ENIGMA2_PICON_KEY.format(int(ssid), int(on_id), namespace), None)
+            return picon_ids.get((int(ssid), int(on_id), namespace), None)
         elif s_type is SettingsType.NEUTRINO_MP:
             tr_id = int(ssid[:-2] if len(ssid) < 4 else ssid[:2])
             return _NEUTRINO_PICON_KEY.format(tr_id, int(on_id), int(ssid))
@@ -119,6 +150,98 @@ class PiconsParser(HTMLParser):
             return "{}.png".format(ssid)
 
 
+class PiconIds:
+    """ Index of the picon ids [file names] of the services.
+
+        Maps (ssid, onid, namespace) to the Enigma2 picon file names
+        and keeps the fav ids of the services which use each picon.
+        Updated incrementally along with the services.
+    """
+
+    def __init__(self):
+        # (ssid, onid, namespace) -> picon ids [in the order of adding].
+        self._ids = defaultdict(dict)
+        self._fav_ids = defaultdict(set)
+        self._data = {}
+
+    def add(self, picon_id, fav_id):
+        if not picon_id:
+            return
+
+        fav_ids = self._fav_ids[picon_id]
+        if not fav_ids:
+            data = self.get_data(picon_id)
+            if data:
+                ssid, tid, on_id, namespace = data
+                self._ids[(ssid, on_id, namespace)][picon_id] = None
+        fav_ids.add(fav_id)
+
+    def remove(self, picon_id, fav_id):
+        fav_ids = self._fav_ids.get(picon_id, None)
+        if fav_ids is None:
+            return
+
+        fav_ids.discard(fav_id)
+        if not fav_ids:
+            del self._fav_ids[picon_id]
+            data = self._data.pop(picon_id, None)
+            if data:
+                key = (data[0], data[2], data[3])
+                picon_ids = self._ids.get(key, None)
+                if picon_ids is not None:
+                    picon_ids.pop(picon_id, None)
+                    if not picon_ids:
+                        del self._ids[key]
+
+    def get(self, key, default=None):
+        """ Returns the picon file name for the given (ssid, onid, namespace) [the first added one]. """
+        picon_ids = self._ids.get(key, None)
+        return next(iter(picon_ids)) if picon_ids else default
+
+    def get_fav_ids(self, picon_id):
+        return self._fav_ids.get(picon_id, ())
+
+    def get_refs_count(self, picon_id):
+        """ Returns the number of the services which use the picon. """
+        return len(self._fav_ids.get(picon_id, ()))
+
+    def get_unused(self, picon_ids):
+        """ Returns a set of the given picon ids which are not used by the services. """
+        return set(picon_ids).difference(self._fav_ids)
+
+    def get_data(self, picon_id):
+        """ Returns (ssid, tid, onid, namespace) for the Enigma2 picon file name or None. """
+        data = self._data.get(picon_id, None)
+        if data:
+            return data
+
+        data = picon_id.split("_")
+        if len(data) < 10:
+            return
+        try:
+            data = int(data[3], 16), int(data[4], 16), int(data[5], 16), int(data[6], 16)
+        except ValueError:
+            return
+        else:
+            if picon_id in self._fav_ids:
+                self._data[picon_id] = data
+            return data
+
+    def clear(self):
+        self._ids.clear()
+        self._fav_ids.clear()
+        self._data.clear()
+
+    def __contains__(self, picon_id):
+        return picon_id in self._fav_ids
+
+    def __iter__(self):
+        return iter(self._fav_ids)
+
+    def __len__(self):
+        return len(self._fav_ids)
+
+
 class ProviderParser(HTMLParser):
     """ Parser for satellite html page. (https://www.lyngsat.com/*sat-name*.html) """
 
@@ -127,10 +250,11 @@ class ProviderParser(HTMLParser):
     _TRANSPONDER_FREQUENCY_PATTERN = re.compile("^\d+ [HVLR]+")
     _DOMAINS = {"/tvchannels/", "/radiochannels/", "/packages/"}
 
-    def __init__(self, entities=False, separator=' '):
+    def __init__(self, entities=False, separator=' ', url=""):
 
         HTMLParser.__init__(self)
         self.convert_charrefs = False
+        self._url = url
 
         self._parse_html_entities = entities
         self._separator = separator
@@ -153,12 +277,15 @@ class ProviderParser(HTMLParser):
         if tag == 'tr':
             self._is_th = True
         if tag == "img":
-            if attrs[0][1].startswith("logo/"):
-                self._current_row.append(attrs[0][1])
-        if tag == "a":
-            url = attrs[0][1]
-            if any(d in url for d in self._DOMAINS):
+            url = urljoin(self._url, dict(attrs).get("src", None) or "")
+            if is_logo_url(url):
                 self._current_row.append(url)
+        if tag == "a":
+            href = dict(attrs).get("href", None)
+            if href:
+                url = urljoin(self._url, href)
+                if any(d in urlsplit(url).path for d in self._DOMAINS):
+                    self._current_row.append(url)
         if tag == "font" and len(attrs) == 1:
             atr = attrs[0]
             if len(atr) == 2 and atr[1] == "darkgreen":
@@ -235,32 +362,434 @@ class ProviderParser(HTMLParser):
         super().reset()
 
 
-def parse_providers(open_path):
-    parser = ProviderParser()
-    parser.reset()
+class PiconsFetcher:
+    """ Concurrent fetcher of the pages and logos.
+
+        The responses are cached on disk and revalidated
+        with conditional requests [ETag, If-Modified-Since].
+        The number of simultaneous requests [max_per_host] and
+        the minimum interval between requests [interval] in seconds are limited per host.
+    """
+
+    def __init__(self, max_workers=8, max_per_host=4, interval=0.05, timeout=10, cache_path=CACHE_PATH):
+        self._max_workers = max_workers
+        self._max_per_host = max_per_host
+        self._interval = interval
+        self._timeout = timeout
+        self._cache_path = cache_path
+        self._lock = Lock()
+        self._hosts_limits = {}
+        self._hosts_times = {}
+        self._terminate = False
+
+    def get(self, url):
+        """ Returns the data for the given url or None. """
+        if self._terminate:
+            return
+
+        path = self.get_cache_path(url)
+        meta = self.get_cache_meta(path)
+        headers = dict(_HEADERS)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta.get("etag")
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta.get("last_modified")
+
+        host = urlsplit(url).netloc
+        with self.get_host_limit(host):
+            self.wait(host)
+            try:
+                with urlopen(Request(url, headers=headers), timeout=self._timeout) as resp:
+                    data = resp.read()
+                    etag, modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+            except HTTPError as e:
+                if e.code == 304:
+                    return self.read_cache(path)
+                log("Getting data error [{}]: {}".format(url, e))
+                return
+            except (URLError, OSError, ValueError) as e:
+                log("Getting data error [{}]: {}".format(url, e))
+                return
+
+        if etag or modified:
+            self.write_cache(path, url, data, etag, modified)
+        return data
+
+    def get_text(self, url):
+        data = self.get(url)
+        if data is not None:
+            return data.decode("utf-8", errors="replace")
+
+    def get_all(self, urls, callback=None):
+        """ Fetches the given urls concurrently.
+
+            Calls the callback [if present] for each url with the received data.
+            Returns a dict of the urls with the data [None if failed].
+        """
+        results = {}
+        urls = list(dict.fromkeys(urls))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {executor.submit(self.get, url): url for url in urls}
+            for future in concurrent.futures.as_completed(futures):
+                if self._terminate:
+                    for f in futures:
+                        f.cancel()
+                    break
+                url, data = futures[future], future.result()
+                results[url] = data
+                if callback:
+                    callback(url, data)
+
+        return results
+
+    def cancel(self):
+        self._terminate = True
+
+    @property
+    def canceled(self):
+        return self._terminate
+
+    def get_host_limit(self, host):
+        with self._lock:
+            limit = self._hosts_limits.get(host)
+            if not limit:
+                limit = BoundedSemaphore(self._max_per_host)
+                self._hosts_limits[host] = limit
+            return limit
+
+    def wait(self, host):
+        """ Waits for the next allowed request time for the host. """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._hosts_times.get(host, now))
+            self._hosts_times[host] = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+    def get_cache_path(self, url):
+        return self._cache_path + hashlib.sha1(url.encode()).hexdigest()
+
+    def get_cache_meta(self, path):
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return meta if os.path.isfile(path) else {}
+
+    def read_cache(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError as e:
+            log("Cache read error: {}".format(e))
+
+    def write_cache(self, path, url, data, etag, modified):
+        """ Writes the data and then the metadata [via temporary files]. """
+        try:
+            os.makedirs(self._cache_path, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self._cache_path, delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+            with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=self._cache_path, delete=False) as f:
+                json.dump({"url": url, "etag": etag, "last_modified": modified}, f)
+            os.replace(f.name, path + ".json")
+        except OSError as e:
+            log("Cache write error: {}".format(e))
+
+
+class PiconsDownloader:
+    """ Pipelined download of the picons for the providers.
+
+        Page fetching, parsing, logos fetching and writing are
+        performed by the separate bounded pools of workers,
+        so the stages for the different providers overlap.
+    """
+
+    def __init__(self, fetcher, picon_ids, s_type=SettingsType.ENIGMA_2, page_workers=4, parse_workers=2,
+                 logo_workers=8, write_workers=2):
+        self._fetcher = fetcher
+        self._picon_ids = picon_ids
+        self._s_type = s_type
+        self._workers = (page_workers, parse_workers, logo_workers, write_workers)
+        self._lock = Lock()
+        self._done = Event()
+        self._pending = 0
+        self._counters = {}
+        self._callback = None
+        self._pages = None
+        self._parsers = None
+        self._logos = None
+        self._writers = None
+
+    def download(self, providers, picons_path, callback=None):
+        """ Downloads the picons for the given providers to the picons path.
+
+            Calls the callback [if present] with the provider,
+            number of the saved picons and their total count when the provider is done.
+            Blocks until all stages are complete. Returns the number of the saved picons.
+        """
+        self._callback = callback
+        self._counters.clear()
+        self._pending = 0
+        self._done.clear()
+        os.makedirs(picons_path, exist_ok=True)
+
+        page_workers, parse_workers, logo_workers, write_workers = self._workers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=page_workers) as self._pages, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=parse_workers) as self._parsers, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=logo_workers) as self._logos, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=write_workers) as self._writers:
+            for prv in providers:
+                self.submit(self._pages, self.fetch_page, prv, picons_path)
+            if providers:
+                self._done.wait()
+
+        return sum(c[2] for c in self._counters.values())
+
+    def submit(self, executor, func, *args):
+        with self._lock:
+            self._pending += 1
+        executor.submit(self.run, func, *args)
+
+    def run(self, func, *args):
+        try:
+            if not self._fetcher.canceled:
+                func(*args)
+        except Exception as e:
+            log("Picons downloading error: {}".format(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._done.set()
+
+    def fetch_page(self, prv, picons_path):
+        html = self._fetcher.get_text(prv.url)
+        if html is None:
+            self.notify(prv, 0, 0)
+        else:
+            self.submit(self._parsers, self.parse, prv, html, picons_path)
+
+    def parse(self, prv, html, picons_path):
+        picons = PiconsParser.parse(html, prv, self._picon_ids, self._s_type)
+        with self._lock:
+            # Total, remaining and saved.
+            self._counters[prv] = [len(picons), len(picons), 0]
+
+        if picons:
+            for url, name in picons.items():
+                self.submit(self._logos, self.fetch_logo, prv, url, picons_path + name)
+        else:
+            self.notify(prv, 0, 0)
 
-    with open(open_path, encoding="utf-8", errors="replace") as f:
-        parser.feed(f.read())
+    def fetch_logo(self, prv, url, path):
+        data = self._fetcher.get(url)
+        if data:
+            self.submit(self._writers, self.write, prv, path, data)
+        else:
+            self.on_logo_done(prv, False)
+
+    def write(self, prv, path, data):
+        try:
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            log("Picon [{}] writing error: {}".format(path, e))
+            self.on_logo_done(prv, False)
+        else:
+            self.on_logo_done(prv, True)
+
+    def on_logo_done(self, prv, saved):
+        with self._lock:
+            total, remaining, count = self._counters[prv]
+            self._counters[prv] = [total, remaining - 1, count + saved]
+            if remaining > 1:
+                return
+        self.notify(prv, count + saved, total)
+
+    def notify(self, prv, saved, total):
+        if self._callback:
+            self._callback(prv, saved, total)
 
-        return parser.rows
+
+def is_logo_url(url):
+    """ Checks if the [resolved] url points to the logo in the site logo directory. """
+    return urlsplit(url).path.startswith("/logo/")
+
+
+def parse_providers(html, url=""):
+    """ Parses the satellite page [html text].
+
+        The links and logos are resolved against the page url.
+    """
+    parser = ProviderParser(url=url)
+    parser.reset()
+    parser.feed(html)
+
+    return parser.rows
 
 
 @run_task
-def convert_to(src_path, dest_path, s_type, callback, done_callback):
+def convert_to(src_path, dest_path, s_type, callback, done_callback, picon_ids=None):
     """ Converts names format of picons.
 
         Copies resulting files from src to dest and writes state to callback.
+        The picon ids index [if present] is used to get the data of the known picons.
     """
+    picon_ids = picon_ids or PiconIds()
     pattern = "/*_0_0_0.png" if s_type is SettingsType.ENIGMA_2 else "/*.png"
-    for file in glob.glob(src_path + pattern):
-        base_name = os.path.basename(file)
-        pic_data = base_name.rstrip(".png").split("_")
-        dest_file = _NEUTRINO_PICON_KEY.format(int(pic_data[4], 16), int(pic_data[5], 16), int(pic_data[3], 16))
-        dest = "{}/{}".format(dest_path, dest_file)
-        callback('Converting "{}" to "{}"\n'.format(base_name, dest_file))
-        shutil.copyfile(file, dest)
-
-    done_callback()
+    files = {}
+    for file in sorted(glob.glob(src_path + pattern)):
+        pic_data = picon_ids.get_data(os.path.basename(file))
+        if pic_data:
+            ssid, tid, on_id, namespace = pic_data
+            # Different services [e.g. with the type 1 and 19] can have the same destination file.
+            files.setdefault("{}/{}".format(dest_path, _NEUTRINO_PICON_KEY.format(tid, on_id, ssid)), file)
+
+    total, errors = len(files), 0
+    try:
+        os.makedirs(dest_path, exist_ok=True)
+        # Reflinks are possible only within the same file system.
+        if os.stat(src_path).st_dev == os.stat(dest_path).st_dev:
+            mode = CopyMode.REFLINK
+            for index, (dest, src) in enumerate(files.items(), start=1):
+                try:
+                    mode = copy_picon(src, dest, mode)
+                except OSError as e:
+                    log("Picon [{}] converting error: {}".format(src, e))
+                    errors += 1
+                if index % _PROGRESS_STEP == 0:
+                    callback("Converting: {}/{} [{}]\n".format(index, total, mode.name.lower()))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=_COPY_WORKERS) as executor:
+                futures = {executor.submit(copy_picon, src, dest, CopyMode.COPY): src for dest, src in files.items()}
+                for index, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                    try:
+                        future.result()
+                    except OSError as e:
+                        log("Picon [{}] converting error: {}".format(futures[future], e))
+                        errors += 1
+                    if index % _PROGRESS_STEP == 0:
+                        callback("Converting: {}/{}\n".format(index, total))
+
+        callback("Converted: {}\n".format(total - errors))
+        if errors:
+            callback("Errors: {} [see the log]\n".format(errors))
+    except OSError as e:
+        callback("Converting error: {}\n".format(e))
+    finally:
+        done_callback()
+
+
+def copy_picon(src, dest, mode=CopyMode.COPY):
+    """ Copies the picon file.
+
+        Tries a reflink, then a plain copy starting with the given mode.
+        Returns the mode used [to start with it for the next files].
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if mode is CopyMode.REFLINK:
+        try:
+            with open(src, "rb") as s_f, open(dest, "wb") as d_f:
+                fcntl.ioctl(d_f.fileno(), _FICLONE, s_f.fileno())
+            return mode
+        except OSError:
+            if os.path.exists(dest):
+                os.remove(dest)
+            mode = CopyMode.COPY
+
+    shutil.copyfile(src, dest)
+    return mode
+
+
+def find_duplicate_picons(path):
+    """ Finds byte-identical picons in the given directory.
+
+        The files are hashed only if there are other files of the same size.
+        Returns a dict of the names of the original files with the lists of their duplicates.
+    """
+    sizes = defaultdict(list)
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith(".png") and entry.is_file(follow_symlinks=False):
+                sizes[entry.stat().st_size].append(entry.name)
+
+    duplicates = {}
+    for names in filter(lambda n: len(n) > 1, sizes.values()):
+        hashes = defaultdict(list)
+        for name in sorted(names):
+            with open(os.path.join(path, name), "rb") as f:
+                hashes[hashlib.sha1(f.read()).digest()].append(name)
+
+        for original, *dups in filter(lambda h: len(h) > 1, hashes.values()):
+            duplicates[original] = dups
+
+    return duplicates
+
+
+def link_duplicate_picons(path, duplicates):
+    """ Replaces the duplicates with hard links to the original files.
+
+        Returns the number of the freed bytes.
+    """
+    freed = 0
+    for original, dups in duplicates.items():
+        src = os.path.join(path, original)
+        src_stat = os.stat(src)
+        for name in dups:
+            dest = os.path.join(path, name)
+            stat = os.stat(dest)
+            if stat.st_ino == src_stat.st_ino and stat.st_dev == src_stat.st_dev:
+                continue
+            # Via a temporary link to replace the file atomically.
+            tmp = dest + ".tmp"
+            os.link(src, tmp)
+            os.replace(tmp, dest)
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+
+    return freed
+
+
+def get_picons_links_commands(duplicates, path):
+    """ Returns the shell commands to replace the duplicates with symlinks in the given path [on the receiver]. """
+    commands = ["cd {}".format(shlex.quote(path))]
+    for original, dups in duplicates.items():
+        commands.extend("ln -sf {} {}".format(shlex.quote(original), shlex.quote(d)) for d in dups)
+
+    return commands
+
+
+def resize_picons(files, size):
+    """ Resizes the picon files [used in the worker processes].
+
+        The files that already have the given size are skipped.
+        Returns the number of the resized files.
+    """
+    from PIL import Image
+
+    count = 0
+    for file in files:
+        # The file is replaced [not rewritten in place] to keep the files linked with it unchanged.
+        tmp = "{}.tmp".format(file)
+        try:
+            with Image.open(file) as img:
+                if img.size == size:
+                    continue
+                img = img.resize(size, Image.LANCZOS)
+            img.save(tmp, "PNG", optimize=True)
+            os.replace(tmp, file)
+        except OSError as e:
+            log("Picon [{}] resizing error: {}".format(file, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        else:
+            count += 1
+
+    return count
 
 
 if __name__ == "__main__":
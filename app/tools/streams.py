@@ -0,0 +1,397 @@
+""" Module for checking the availability of IPTV streams """
+import concurrent.futures
+import time
+from collections import namedtuple, defaultdict, OrderedDict
+from enum import Enum
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Lock, BoundedSemaphore
+from urllib.parse import urlsplit, urljoin
+
+from app.commons import log
+
+_HEADERS = {"User-Agent": "Mozilla/5.0 (X11; Linux i586; rv:31.0) Gecko/20100101 Firefox/69.0",
+            "Accept": "*/*",
+            "Connection": "keep-alive"}
+_RANGE_HEADERS = dict(_HEADERS, Range="bytes=0-0")
+_CONNECTIONS = {"http": HTTPConnection, "https": HTTPSConnection}
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Some servers don't support HEAD requests or refuse them with these codes.
+_HEAD_UNSUPPORTED_CODES = (400, 404, 405, 406, 500, 501)
+_MAX_REDIRECTS = 5
+_MAX_IDLE_CONNECTIONS = 4
+_MAX_DRAIN_SIZE = 65536
+# Deep check.
+_PLAYLIST_SIZE = 262144
+_SAMPLE_SIZE = 188 * 512
+_TS_PACKET_SIZE = 188
+_TS_SYNC_BYTE = 0x47
+_HLS_TAG = b"#EXTM3U"
+_HLS_VARIANT_TAG = "#EXT-X-STREAM-INF"
+_HLS_END_TAG = "#EXT-X-ENDLIST"
+_HTML_TAGS = (b"<!doctype html", b"<html")
+# Results cache.
+_CACHE_SIZE = 10000
+_FAILURE_TTL = 30  # For the unavailable streams [the errors without the response are not cached].
+
+
+class StreamKind(Enum):
+    UNKNOWN = "Unknown"
+    HLS = "HLS"
+    TS = "TS"
+    OTHER = "Other"
+
+
+ProbeResult = namedtuple("ProbeResult", ["url", "available", "status", "time", "ttfb", "bitrate", "kind"])
+
+
+class StreamsChecker:
+    """ Concurrent checker of the streams availability.
+
+        Uses HEAD (or 1-byte Range GET as a fallback) requests and
+        keep-alive connections shared between the requests to the same host.
+        The results are cached by URL for the given time [ttl] in seconds
+        [the shorter one for the unavailable streams]. The size of the cache is bounded.
+
+        In the deep mode, the stream data is requested and should be received
+        within the given time [deadline] in seconds. For HLS streams, the playlists
+        are resolved and the segment data is checked. TS data must contain the sync bytes.
+    """
+    _CACHE = OrderedDict()
+    _CACHE_LOCK = Lock()
+
+    def __init__(self, max_workers=16, max_per_host=4, timeout=2, ttl=600, deep=False, deadline=5):
+        self._max_workers = max_workers
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._ttl = ttl
+        self._deep = deep
+        self._deadline = deadline
+        self._lock = Lock()
+        self._connections = defaultdict(list)
+        self._hosts_limits = {}
+        self._terminate = False
+
+    def check(self, urls, callback=None):
+        """ Checks the given urls.
+
+            Calls the callback [if present] for each checked url with the probe result.
+            Returns the list of results for unique urls in the order of completion.
+        """
+        self._terminate = False
+        results = []
+        urls = list(dict.fromkeys(urls))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [executor.submit(self.probe, url) for url in urls]
+            for future in concurrent.futures.as_completed(futures):
+                if self._terminate:
+                    for f in futures:
+                        f.cancel()
+                    break
+                result = future.result()
+                results.append(result)
+                if callback:
+                    callback(result)
+        self.close()
+        return results
+
+    def probe(self, url):
+        """ Returns probe result for the given url. """
+        cached = self.get_cached(url)
+        if cached:
+            return cached
+
+        result = self.probe_health(url) if self._deep else self.probe_status(url)
+        if not self._terminate and result.status:
+            ttl = self._ttl if result.available else min(self._ttl, _FAILURE_TTL)
+            key = (url, self._deep)
+            with self._CACHE_LOCK:
+                self._CACHE[key] = (time.monotonic(), ttl, result)
+                self._CACHE.move_to_end(key)
+                while len(self._CACHE) > _CACHE_SIZE:
+                    self._CACHE.popitem(last=False)
+        return result
+
+    def probe_status(self, url):
+        start = time.perf_counter()
+        status = 0
+        if url and not self._terminate:
+            try:
+                try:
+                    status = self.request(url, "HEAD")
+                except HTTPException:
+                    status = _HEAD_UNSUPPORTED_CODES[0]  # Possibly the HEAD request was dropped.
+                if status in _HEAD_UNSUPPORTED_CODES:
+                    status = self.request(url, "GET")
+            except (OSError, HTTPException, ValueError) as e:
+                log("Stream check [{}] error: {}".format(url, e))
+
+        elapsed = time.perf_counter() - start
+        return ProbeResult(url, self.is_available(status), status, elapsed, elapsed, 0, StreamKind.UNKNOWN)
+
+    def probe_health(self, url):
+        """ Checks that the stream data can be received before the deadline. """
+        start = time.perf_counter()
+        deadline = start + self._deadline
+        status, ttfb, bitrate, kind, available = 0, None, 0, StreamKind.UNKNOWN, False
+        if url and not self._terminate:
+            try:
+                status, data, ttfb, bitrate, real_url, content_type = self.fetch(url, _PLAYLIST_SIZE, deadline)
+                if self.is_successful(status):
+                    if data.lstrip(b"\xef\xbb\xbf \r\n").startswith(_HLS_TAG):
+                        kind = StreamKind.HLS
+                        available, bitrate = self.check_hls(real_url, data, deadline)
+                    elif self.has_ts_sync(data):
+                        kind, available = StreamKind.TS, True
+                    else:
+                        # E.g. radio, progressive video or DASH manifest. The error and login pages are rejected.
+                        kind, available = StreamKind.OTHER, self.is_media(content_type, data)
+            except (OSError, HTTPException, ValueError) as e:
+                log("Stream check [{}] error: {}".format(url, e))
+
+        elapsed = time.perf_counter() - start
+        return ProbeResult(url, available, status, elapsed, ttfb, bitrate if available else 0, kind)
+
+    def check_hls(self, url, data, deadline):
+        """ Resolves the HLS playlists and checks the data of the segment.
+
+            The URIs are resolved against the effective [after redirects] URL of the playlist.
+            Returns the availability flag and the bitrate of the segment download.
+        """
+        playlist = data.decode("utf-8", errors="ignore")
+        if _HLS_VARIANT_TAG in playlist:
+            url = self.get_hls_uri(url, playlist, _HLS_VARIANT_TAG)
+            if not url:
+                return False, 0
+            status, data, _, bitrate, url, _ = self.fetch(url, _PLAYLIST_SIZE, deadline)
+            if not self.is_successful(status):
+                return False, 0
+            playlist = data.decode("utf-8", errors="ignore")
+
+        # The latest segment of the live playlist is the most likely to be available.
+        url = self.get_hls_uri(url, playlist, "#EXTINF", _HLS_END_TAG not in playlist)
+        if not url:
+            return False, 0
+        status, data, _, bitrate, url, _ = self.fetch(url, _SAMPLE_SIZE, deadline)
+        if not self.is_successful(status) or not data:
+            return False, 0
+        is_ts = urlsplit(url).path.endswith(".ts") or data[0] == _TS_SYNC_BYTE
+        return not is_ts or self.has_ts_sync(data), bitrate
+
+    def fetch(self, url, size, deadline, redirects=_MAX_REDIRECTS):
+        """ Reads up to [size] bytes of the url data before the deadline.
+
+            Returns the response status, data, time to the first byte, bitrate [bits/s],
+            the effective URL [after redirects] and the content type.
+        """
+        scheme, host, path, query, fragment = urlsplit(url)
+        if scheme not in _CONNECTIONS:
+            raise ValueError("Unsupported scheme: {}".format(scheme))
+
+        path = "{}?{}".format(path or "/", query) if query else path or "/"
+        key = (scheme, host)
+        with self.get_host_limit(key):
+            status, location, data, ttfb, bitrate, content_type = self.read(key, path, size, deadline)
+
+        if status in _REDIRECT_CODES and location and redirects > 0:
+            return self.fetch(urljoin(url, location), size, deadline, redirects - 1)
+        return status, data, ttfb, bitrate, url, content_type
+
+    def read(self, key, path, size, deadline, retry=True):
+        start = time.perf_counter()
+        conn, reused = self.get_connection(key)
+        reusable = False
+        data, ttfb, bitrate = bytearray(), None, 0
+        try:
+            self.set_timeout(conn, deadline)
+            conn.request("GET", path, headers=_HEADERS)
+            resp = conn.getresponse()
+        except (OSError, HTTPException):
+            conn.close()
+            if reused and retry:
+                # The idle connection may have been closed by the server.
+                return self.read(key, path, size, deadline, False)
+            raise
+
+        try:
+            first = time.perf_counter()
+            ttfb = first - start
+            while len(data) < size and time.perf_counter() < deadline and not self._terminate:
+                self.set_timeout(conn, deadline)
+                chunk = resp.read1(size - len(data))
+                if not chunk:
+                    break
+                if not data:
+                    first = time.perf_counter()
+                    ttfb = first - start
+                data.extend(chunk)
+            elapsed = time.perf_counter() - first
+            bitrate = int(len(data) * 8 / elapsed) if elapsed > 0 else 0
+            reusable = resp.isclosed() and not resp.will_close
+        finally:
+            if reusable:
+                self.release_connection(key, conn)
+            else:
+                conn.close()
+
+        return resp.status, resp.getheader("Location"), bytes(data), ttfb, bitrate, resp.getheader("Content-Type", "")
+
+    @staticmethod
+    def set_timeout(conn, deadline):
+        timeout = deadline - time.perf_counter()
+        if timeout <= 0:
+            raise TimeoutError("Deadline exceeded.")
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+
+    @staticmethod
+    def get_hls_uri(url, playlist, tag, last=False):
+        """ Returns the absolute URI following the tag in the playlist. """
+        uris, tagged = [], False
+        for line in playlist.splitlines():
+            line = line.strip()
+            if line.startswith(tag):
+                tagged = True
+            elif tagged and line and not line.startswith("#"):
+                if not last:
+                    return urljoin(url, line)
+                uris.append(line)
+                tagged = False
+
+        return urljoin(url, uris[-1]) if uris else None
+
+    @staticmethod
+    def is_media(content_type, data):
+        """ Checks that the data of the successful response is not an HTML page. """
+        content_type = content_type.split(";")[0].strip().lower()
+        if content_type.startswith(("audio/", "video/")):
+            return True
+        if not data or content_type in ("text/html", "application/xhtml+xml"):
+            return False
+        return not data[:512].lstrip().lower().startswith(_HTML_TAGS)
+
+    @staticmethod
+    def has_ts_sync(data):
+        """ Checks for the sync bytes of two consecutive TS packets. """
+        for i in range(min(len(data), _TS_PACKET_SIZE)):
+            if data[i] == _TS_SYNC_BYTE:
+                if len(data) <= i + _TS_PACKET_SIZE or data[i + _TS_PACKET_SIZE] == _TS_SYNC_BYTE:
+                    return True
+        return False
+
+    @staticmethod
+    def get_health_key(result):
+        """ Returns the sorting key of the result [available and faster streams first]. """
+        if not result or not result.available:
+            return 1, 0, 0
+        return 0, result.ttfb or 0, -result.bitrate
+
+    def request(self, url, method, redirects=_MAX_REDIRECTS):
+        """ Sends a request and returns the response status.
+
+            For the GET method only one byte of the body is requested and read.
+        """
+        scheme, host, path, query, fragment = urlsplit(url)
+        if scheme not in _CONNECTIONS:
+            raise ValueError("Unsupported scheme: {}".format(scheme))
+
+        path = "{}?{}".format(path or "/", query) if query else path or "/"
+        key = (scheme, host)
+        with self.get_host_limit(key):
+            status, location = self.send(key, method, path)
+
+        if status in _REDIRECT_CODES and location and redirects > 0:
+            return self.request(urljoin(url, location), method, redirects - 1)
+        return status
+
+    def send(self, key, method, path, retry=True):
+        conn, reused = self.get_connection(key)
+        reusable = False
+        try:
+            conn.request(method, path, headers=_HEADERS if method == "HEAD" else _RANGE_HEADERS)
+            resp = conn.getresponse()
+            status, location = resp.status, resp.getheader("Location")
+            if method == "HEAD" or resp.length is not None and resp.length <= _MAX_DRAIN_SIZE:
+                # A short body is drained to keep the connection alive.
+                resp.read()
+                reusable = not resp.will_close
+            else:
+                resp.read(1)
+        except (OSError, HTTPException):
+            if reused and retry:
+                # The idle connection may have been closed by the server.
+                conn.close()
+                return self.send(key, method, path, False)
+            raise
+        finally:
+            if reusable:
+                self.release_connection(key, conn)
+            else:
+                conn.close()
+
+        return status, location
+
+    def get_host_limit(self, key):
+        with self._lock:
+            limit = self._hosts_limits.get(key)
+            if not limit:
+                limit = BoundedSemaphore(self._max_per_host)
+                self._hosts_limits[key] = limit
+            return limit
+
+    def get_connection(self, key):
+        with self._lock:
+            idle = self._connections[key]
+            if idle:
+                return idle.pop(), True
+
+        scheme, host = key
+        return _CONNECTIONS.get(scheme)(host, timeout=self._timeout), False
+
+    def release_connection(self, key, conn):
+        with self._lock:
+            idle = self._connections[key]
+            if len(idle) < _MAX_IDLE_CONNECTIONS and not self._terminate:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def get_cached(self, url):
+        key = (url, self._deep)
+        with self._CACHE_LOCK:
+            cached = self._CACHE.get(key)
+            if cached:
+                created, ttl, result = cached
+                if time.monotonic() - created < min(ttl, self._ttl):
+                    return result
+                del self._CACHE[key]
+
+    def close(self):
+        """ Closes all idle connections. """
+        with self._lock:
+            connections = [c for idle in self._connections.values() for c in idle]
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def cancel(self):
+        self._terminate = True
+
+    @staticmethod
+    def is_available(status):
+        """ 403 is allowed because many servers forbid the access without a proper player token. """
+        return 0 < status < 400 or status == 403
+
+    @staticmethod
+    def is_successful(status):
+        """ Only the successful responses [including partial content] are considered for the data check. """
+        return 200 <= status < 300
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._CACHE_LOCK:
+            cls._CACHE.clear()
+
+
+if __name__ == "__main__":
+    pass
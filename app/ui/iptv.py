@@ -1,9 +1,8 @@
 import concurrent.futures
 import re
-import urllib
-from urllib.error import HTTPError
+import time
+from urllib.error import URLError
 from urllib.parse import urlparse, unquote, quote
-from urllib.request import Request, urlopen
 
 from gi.repository import GLib
 
@@ -11,6 +10,7 @@ from app.commons import run_idle, run_task
 from app.eparser.ecommons import BqServiceType, Service
 from app.eparser.iptv import NEUTRINO_FAV_ID_FORMAT, StreamType, ENIGMA2_FAV_ID_FORMAT, get_fav_id, MARKER_FORMAT
 from app.settings import SettingsType
+from app.tools.streams import StreamsChecker
 from app.tools.yt import PlayListParser, YouTubeException, YouTube
 from .dialogs import Action, show_dialog, DialogType, get_dialogs_string, get_message
 from .main_helper import get_base_model, get_iptv_url, on_popup_menu
@@ -21,6 +21,7 @@ _DIGIT_ENTRY_NAME = "digit-entry"
 _ENIGMA2_REFERENCE = "{}:0:{}:{:X}:{:X}:{:X}:{:X}:0:0:0"
 _PATTERN = re.compile("(?:^[\\s]*$|\\D)")
 _UI_PATH = UI_RESOURCES_PATH + "iptv.glade"
+_UPDATE_INTERVAL = 0.1
 
 
 def is_data_correct(elems):
@@ -228,7 +229,7 @@ class IptvDialog:
                 yield True
             links, title = self._yt_dl.get_yt_link(video_id, entry.get_text())
             yield True
-        except urllib.error.URLError as e:
+        except URLError as e:
             self.show_info_message(get_message("Getting link error:") + (str(e)), Gtk.MessageType.ERROR)
             return
         except YouTubeException as e:
@@ -312,7 +313,7 @@ class IptvDialog:
 
 class SearchUnavailableDialog:
 
-    def __init__(self, transient, model, fav_bouquet, iptv_rows, s_type):
+    def __init__(self, transient, model, fav_bouquet, iptv_rows, s_type, deep=False):
         handlers = {"on_response": self.on_response}
 
         builder = Gtk.Builder()
@@ -327,55 +328,52 @@ class SearchUnavailableDialog:
         self._level_bar = builder.get_object("unavailable_streams_level_bar")
         self._bouquet = fav_bouquet
         self._s_type = s_type
-        self._iptv_rows = iptv_rows
-        self._counter = -1
-        self._max_rows = len(self._iptv_rows)
+        self._max_rows = len(iptv_rows)
         self._level_bar.set_max_value(self._max_rows)
         self._download_task = True
         self._to_delete = []
-
-        self.update_counter()
+        self._checked = 0
+        self._last_update = 0
+        self._checker = StreamsChecker(deep=deep)
+        self._results = {}
+        # Rows with the same url are checked once.
+        self._urls = {}
+        for row in iptv_rows:
+            self._urls.setdefault(get_iptv_url(row, s_type), []).append(model.get_iter(row.path))
+
+        self.update_progress()
         self.do_search()
 
     @run_task
     def do_search(self):
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {executor.submit(self.get_unavailable, row): row for row in self._iptv_rows}
-            for future in concurrent.futures.as_completed(futures):
-                if not self._download_task:
-                    executor.shutdown()
-                    return
-                future.result()
-            self._download_task = False
-        self.on_close()
-
-    def get_unavailable(self, row):
+        self._checker.check(self._urls, self.on_checked)
         if not self._download_task:
             return
-        try:
-            req = Request(get_iptv_url(row, self._s_type))
-            self.update_bar()
-            urlopen(req, timeout=2)
-        except HTTPError as e:
-            if e.code != 403:
-                self.append_data(row)
-        except Exception:
-            self.append_data(row)
-
-    def append_data(self, row):
-        self._to_delete.append(self._model.get_iter(row.path))
-        self.update_counter()
+        self._download_task = False
+        self.update_progress()
+        self.on_close()
 
-    @run_idle
-    def update_bar(self):
-        self._max_rows -= 1
-        self._level_bar.set_value(self._max_rows)
+    @property
+    def results(self):
+        """ Returns the check results [with the latency and bitrate metrics for the deep check] by url. """
+        return self._results
+
+    def on_checked(self, result):
+        self._results[result.url] = result
+        itrs = self._urls.get(result.url, ())
+        self._checked += len(itrs)
+        if not result.available:
+            self._to_delete.extend(itrs)
+        # Updating the GTK elements for each row is too costly for big lists.
+        now = time.monotonic()
+        if now - self._last_update > _UPDATE_INTERVAL:
+            self._last_update = now
+            self.update_progress()
 
     @run_idle
-    def update_counter(self):
-        self._counter += 1
-        self._counter_label.set_text(str(self._counter))
+    def update_progress(self):
+        self._level_bar.set_value(self._max_rows - self._checked)
+        self._counter_label.set_text(str(len(self._to_delete)))
 
     def show(self):
         response = self._dialog.run()
@@ -391,6 +389,7 @@ class SearchUnavailableDialog:
         if self._download_task and show_dialog(DialogType.QUESTION, self._dialog) == Gtk.ResponseType.CANCEL:
             return
         self._download_task = False
+        self._checker.cancel()
         self._dialog.destroy()
 
 
@@ -1,6 +1,6 @@
 import os
 import sys
-from contextlib import suppress
+from collections import OrderedDict
 from datetime import datetime
 from functools import lru_cache
 from itertools import chain
@@ -10,14 +10,15 @@ from gi.repository import GLib, Gio
 from app.commons import run_idle, log, run_task, run_with_delay, init_logger
 from app.connections import (HttpAPI, HttpRequestType, download_data, DownloadType, upload_data, test_http,
                              TestException, HttpApiException, STC_XML_FILE)
-from app.eparser import get_blacklist, write_blacklist, parse_m3u
+from app.eparser import get_blacklist, write_blacklist
 from app.eparser import get_services, get_bouquets, write_bouquets, write_services, Bouquets, Bouquet, Service
 from app.eparser.ecommons import CAS, Flag, BouquetService
 from app.eparser.enigma.bouquets import BqServiceType
-from app.eparser.iptv import export_to_m3u
+from app.eparser.iptv import export_to_m3u, export_all_to_m3u, iter_m3u
 from app.eparser.neutrino.bouquets import BqType
 from app.settings import SettingsType, Settings, SettingsException, PlayStreamsMode, SettingsReadException
 from app.tools.media import Player, Recorder, HttpPlayer
+from app.tools.streams import StreamsChecker
 from app.ui.epg_dialog import EpgDialog
 from app.ui.transmitter import LinksTransmitter
 from .backup import BackupDialog, backup_data, clear_data_path
@@ -27,13 +28,16 @@ from .imports import ImportDialog, import_bouquet
 from .iptv import IptvDialog, SearchUnavailableDialog, IptvListConfigurationDialog, YtListImportDialog
 from .main_helper import (insert_marker, move_items, rename, ViewTarget, set_flags, locate_in_services,
                           scroll_to, get_base_model, update_picons_data, copy_picon_reference, assign_picons,
-                          remove_picon, is_only_one_item_selected, gen_bouquets, BqGenType, get_iptv_url, append_picons,
-                          get_selection, get_model_data, remove_all_unused_picons, get_picon_pixbuf, get_base_itrs)
+                          remove_picon, is_only_one_item_selected, gen_bouquets, BqGenType, get_iptv_url,
+                          get_selection, get_model_data, remove_all_unused_picons, get_base_itrs, PiconsCache, Services,
+                          BouquetsStore, restore_picons,
+                          set_picons_data_func, prefetch_visible_picons)
 from .picons_manager import PiconsDialog
 from .satellites_dialog import show_satellites_dialog
 from .search import SearchProvider
 from .service_details_dialog import ServiceDetailsDialog, Action
 from .settings_dialog import show_settings_dialog
+from .thumbnails import ThumbnailsCache
 from .uicommons import (Gtk, Gdk, UI_RESOURCES_PATH, LOCKED_ICON, HIDE_ICON, IPTV_ICON, MOVE_KEYS, KeyboardKey, Column,
                         FavClickMode, MOD_MASK)
 
@@ -45,6 +49,8 @@ class Application(Gtk.Application):
 
     DEL_FACTOR = 50  # Batch size to delete in one pass.
     FAV_FACTOR = DEL_FACTOR * 2
+    LOAD_FACTOR = 5000  # Batch size to load in one pass [into the detached model].
+    FAV_CACHE_SIZE = 5  # Number of the recently viewed bouquets models kept for switching.
 
     _TV_TYPES = ("TV", "TV (HD)", "TV (UHD)", "TV (H264)")
 
@@ -120,6 +126,8 @@ class Application(Gtk.Application):
                     "on_import_yt_list": self.on_import_yt_list,
                     "on_import_m3u": self.on_import_m3u,
                     "on_export_to_m3u": self.on_export_to_m3u,
+                    "on_export_all_to_m3u": self.on_export_all_to_m3u,
+                    "on_export_all_to_one_m3u": self.on_export_all_to_one_m3u,
                     "on_import_bouquet": self.on_import_bouquet,
                     "on_import_bouquets": self.on_import_bouquets,
                     "on_backup_tool_show": self.on_backup_tool_show,
@@ -133,6 +141,7 @@ class Application(Gtk.Application):
                     "on_remove_picon": self.on_remove_picon,
                     "on_reference_picon": self.on_reference_picon,
                     "on_remove_unused_picons": self.on_remove_unused_picons,
+                    "on_restore_picons": self.on_restore_picons,
                     "on_search_down": self.on_search_down,
                     "on_search_up": self.on_search_up,
                     "on_search": self.on_search,
@@ -154,6 +163,7 @@ class Application(Gtk.Application):
                     "on_main_window_state": self.on_main_window_state,
                     "on_record": self.on_record,
                     "on_remove_all_unavailable": self.on_remove_all_unavailable,
+                    "on_sort_by_stream_health": self.on_sort_by_stream_health,
                     "on_new_bouquet": self.on_new_bouquet,
                     "on_create_bouquet_for_current_satellite": self.on_create_bouquet_for_current_satellite,
                     "on_create_bouquet_for_each_satellite": self.on_create_bouquet_for_each_satellite,
@@ -169,17 +179,30 @@ class Application(Gtk.Application):
         self._rows_buffer = []
         self._bouquets_buffer = []
         self._picons_buffer = []
-        self._services = {}
-        self._bouquets = {}
-        self._data_hash = 0
+        self._services = Services()
+        self._bouquets = BouquetsStore()
+        # Version of the data at the last loading or saving.
+        self._saved_version = None
         # For bouquets with different names of services in bouquet and main list
         self._extra_bouquets = {}
-        self._picons = {}
+        # Models of the recently viewed bouquets by id -> (model, services, bouquet version, services version).
+        self._fav_models = OrderedDict()
+        # Id and services of the bouquet in the current fav model [None if the model isn't consistent with them].
+        self._fav_bq = None
+        self._picons = PiconsCache()
+        self._picons_pending = set()  # Views waiting for the picons update
         self._blacklist = set()
         self._current_bq_name = None
         self._bq_selected = ""  # Current selected bouquet
         # Current satellite positions in the services list
         self._sat_positions = []
+        # Filter state [updated before each refilter]
+        self._filter_text = ""
+        self._filter_matches = None
+        self._filter_version = None
+        self._filter_type = None
+        self._filter_pos = None
+        self._filter_free = False
         self._marker_types = {BqServiceType.MARKER.name, BqServiceType.SPACE.name}
         # Player
         self._player = None
@@ -302,6 +325,15 @@ class Application(Gtk.Application):
         d_elements = (self._SERVICE_ELEMENTS, self._BOUQUET_ELEMENTS, self._COMMONS_ELEMENTS, self._FAV_ELEMENTS,
                       self._FAV_ENIGMA_ELEMENTS, self._FAV_IPTV_ELEMENTS, self._LOCK_HIDE_ELEMENTS)
         self._tool_elements = {k: builder.get_object(k) for k in set(chain.from_iterable(d_elements))}
+        # Picons are drawn from the cache and loaded on demand for the visible rows
+        set_picons_data_func(builder.get_object("picon_column"), builder.get_object("picon_cellrendererpixbuf"),
+                             self._picons, self.get_srv_picon_id)
+        set_picons_data_func(builder.get_object("fav_service_column"),
+                             builder.get_object("fav_picon_cellrendererpixbuf"), self._picons, self.get_fav_picon_id)
+        for view in (self._services_view, self._fav_view):
+            adjustment = view.get_vadjustment()
+            adjustment.connect("value-changed", self.on_view_adjustment_changed, view)
+            adjustment.connect("changed", self.on_view_adjustment_changed, view)
         # Style
         self._style_provider = Gtk.CssProvider()
         self._style_provider.load_from_path(UI_RESOURCES_PATH + "style.css")
@@ -461,6 +493,7 @@ class Application(Gtk.Application):
 
             If update=False - first call on program start, else - after options changes!
         """
+        self._fav_models.clear()
         if self._s_type is SettingsType.ENIGMA_2:
             self._use_colors = self._settings.use_colors
 
@@ -505,6 +538,8 @@ class Application(Gtk.Application):
                     return True
             self._recorder.release()
 
+        ThumbnailsCache.save_all()
+
         if not self.is_data_saved():
             gen = self.save_data(lambda: GLib.idle_add(self.quit))
             GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
@@ -684,12 +719,9 @@ class Application(Gtk.Application):
             # There are channels with the same parameters except for the name.
             # None because it can have duplicates! Need fix
             fav_id = row[Column.SRV_FAV_ID]
-            for bq in self._bouquets:
-                services = self._bouquets[bq]
-                if services:
-                    with suppress(ValueError):
-                        services.remove(fav_id)
-                        srv_ids_to_delete.add(fav_id)
+            for bq in self._bouquets.get_bouquets(fav_id):
+                self._bouquets[bq].remove(fav_id)
+                srv_ids_to_delete.add(fav_id)
             self._services.pop(fav_id, None)
 
         for f_itr in filter(lambda r: r[Column.FAV_ID] in srv_ids_to_delete, self._fav_model):
@@ -710,7 +742,7 @@ class Application(Gtk.Application):
             if len(model.get_path(itr)) < 2:
                 continue
 
-            self._fav_model.clear()
+            self.clear_fav_model()
             yield True
             b_row = self._bouquets_model[itr][:]
             self._bouquets.pop("{}:{}".format(b_row[Column.BQ_NAME], b_row[Column.BQ_TYPE]), None)
@@ -913,7 +945,7 @@ class Application(Gtk.Application):
         target_column = Column.FAV_ID if target is ViewTarget.FAV else Column.SRV_FAV_ID
         srv = self._services.get(model[path][target_column], None)
         if srv and srv.picon_id:
-            tooltip.set_icon(get_picon_pixbuf(self._settings.picons_local_path + srv.picon_id, size=96))
+            tooltip.set_icon(self._picons.get(srv.picon_id, None, size=96))
             tooltip.set_text(
                 self.get_hint_for_bq_list(srv) if target is ViewTarget.FAV else self.get_hint_for_srv_list(srv))
             view.set_tooltip_row(tooltip, path)
@@ -1063,7 +1095,7 @@ class Application(Gtk.Application):
                     fav_id = ext_row[Column.SRV_FAV_ID]
                     ch = self._services[fav_id]
                     model.insert(dest_index, (0, ch.coded, ch.service, ch.locked, ch.hide, ch.service_type, ch.pos,
-                                              ch.fav_id, self._picons.get(ch.picon_id, None), None, None))
+                                              ch.fav_id, None, None, None))
                     fav_bouquet.insert(dest_index, ch.fav_id)
             elif source == self.FAV_MODEL_NAME:
                 in_itrs = [model.get_iter_from_string(itr) for itr in itrs]
@@ -1235,7 +1267,7 @@ class Application(Gtk.Application):
             yield True
             self.on_view_focus(self._services_view)
             yield True
-            self._data_hash = self.get_data_hash()
+            self._saved_version = self.get_data_version()
             yield True
 
     def append_data(self, bouquets, services):
@@ -1296,7 +1328,7 @@ class Application(Gtk.Application):
                         picon_id = "{}_{}_{}_{}_{}_{}_{}_{}_{}_{}.png".format(*fav_id_data[:10])
                         locked = LOCKED_ICON if data_id in self._blacklist else None
                 srv = Service(None, None, icon, srv.name, locked, None, None, s_type.name,
-                              self._picons.get(picon_id, None), picon_id, *agr, data_id, fav_id, None)
+                              None, picon_id, *agr, data_id, fav_id, None)
                 self._services[fav_id] = srv
             elif srv.name:
                 extra_services[fav_id] = srv.name
@@ -1318,45 +1350,77 @@ class Application(Gtk.Application):
                     break
 
     def append_services(self, services):
+        """ Appends the services to the model.
+
+            The rows are added with the detached view. The empty model is replaced by
+            a new one [not yet wrapped by the filter and sort models] filled in batches.
+        """
         for srv in services:
             #  Adding channels to dict with fav_id as keys.
             self._services[srv.fav_id] = srv
-        self.update_services_counts(len(self._services.values()))
-        factor = self.DEL_FACTOR * 2
+        self.update_services_counts()
 
-        for index, srv in enumerate(services):
-            tooltip, background = None, None
+        bulk = len(self._services_model) == 0
+        model = self.create_services_model() if bulk else self._services_model
+        s_model = self._services_view.get_model()
+        self._services_view.set_model(None)
+        yield True
+
+        # Only the columns with the data are set [picon and tooltip are filled on demand].
+        insert = model.insert_with_valuesv
+        for index, srv in enumerate(services, start=1):
+            columns = [c for c, v in enumerate(srv) if v is not None and c != Column.SRV_PICON]
+            values = [srv[c] for c in columns]
             if self._use_colors:
                 flags = srv.flags_cas
-                if flags:
+                if flags and "f:" in flags:
                     f_flags = list(filter(lambda x: x.startswith("f:"), flags.split(",")))
                     if f_flags and Flag.is_new(int(f_flags[0][2:])):
-                        background = self._NEW_COLOR
+                        columns.append(Column.SRV_BACKGROUND)
+                        values.append(self._NEW_COLOR)
 
-            s = srv._replace(picon=self._picons.get(srv.picon_id, None)) + (tooltip, background)
-            self._services_model.append(s)
-            if index % factor == 0:
+            insert(-1, columns, values)
+            if index % self.LOAD_FACTOR == 0:
                 yield True
+
+        if bulk:
+            self.set_services_model(model, s_model)
+        else:
+            self._services_view.set_model(s_model)
         yield True
 
+    def create_services_model(self):
+        """ Returns a new empty model with the same columns as the services model. """
+        model = Gtk.ListStore(*(self._services_model.get_column_type(c)
+                                for c in range(self._services_model.get_n_columns())))
+        Gtk.Buildable.set_name(model, self.SERVICE_MODEL_NAME)
+        model.connect("row-deleted", self.on_model_changed)
+        return model
+
+    def set_services_model(self, model, s_model=None):
+        """ Sets the new services model with the filter and sort wrappers keeping the current sorting. """
+        s_model = s_model or self._services_view.get_model()
+        self._services_model = model
+        self._services_model_filter = model.filter_new()
+        self._services_model_filter.set_visible_func(self.services_filter_function)
+        sort_model = Gtk.TreeModelSort(model=self._services_model_filter)
+        if s_model:
+            is_sorted, column_id, order = s_model.get_sort_column_id()
+            if is_sorted and column_id >= 0:
+                sort_model.set_sort_column_id(column_id, order)
+        self._services_view.set_model(sort_model)
+
     def clear_current_data(self):
-        """ Clearing current data from lists """
-        if len(self._services_model) > self.DEL_FACTOR * 100:
-            self._wait_dialog.set_text("Deleting data...")
+        """ Clearing current data from lists.
 
+            The services model is replaced by a new empty one instead of removing the rows.
+        """
         self._bouquets_model.clear()
         yield True
-        self._fav_model.clear()
-        yield True
-        s_model = self._services_view.get_model()
-        self._services_view.set_model(None)
+        self.clear_fav_model()
         yield True
-        for index, itr in enumerate([row.iter for row in self._services_model]):
-            self._services_model.remove(itr)
-            if index % self.DEL_FACTOR == 0:
-                yield True
+        self.set_services_model(self.create_services_model())
         yield True
-        self._services_view.set_model(s_model)
         self._blacklist.clear()
         self._services.clear()
         self._rows_buffer.clear()
@@ -1431,7 +1495,7 @@ class Application(Gtk.Application):
 
         self._save_header_button.set_sensitive(True)
         yield True
-        self._data_hash = self.get_data_hash()
+        self._saved_version = self.get_data_version()
         yield True
         if callback:
             callback()
@@ -1462,8 +1526,9 @@ class Application(Gtk.Application):
             self._bouquets_model.append(None, ["WEBTV", None, None, BqType.WEBTV.value])
         yield True
 
-    def on_services_selection(self, model, path, column):
-        self.update_service_bar(model, path)
+    def on_services_selection(self, view, path, column):
+        """ The model is taken from the view [the services model is replaced on loading and clearing]. """
+        self.update_service_bar(view.get_model(), path)
 
     def update_service_bar(self, model, path):
         def_val = "Unknown"
@@ -1494,7 +1559,11 @@ class Application(Gtk.Application):
             GLib.idle_add(lambda: next(gen, False))
 
     def update_bouquet_services(self, model, path, bq_key=None):
-        """ Updates list of bouquet services """
+        """ Updates list of bouquet services.
+
+            The model of the recently viewed bouquet is taken from the cache
+            if neither the bouquet nor the services have been changed since.
+        """
         tree_iter = None
         if path:
             tree_iter = model.get_iter(path)
@@ -1503,12 +1572,26 @@ class Application(Gtk.Application):
         services = self._bouquets.get(key, [])
         ex_services = self._extra_bouquets.get(key, None)
 
+        self.cache_fav_model()
+        cached = self._fav_models.pop(key, None)
+        if cached:
+            fav_model, bq_services, bq_version, srv_version = cached
+            if bq_services is services and bq_version == services.version and srv_version == self._services.version:
+                self._fav_model = fav_model
+                self._fav_bq = (key, services)
+                self._fav_view.set_model(fav_model)
+                self._fav_count_label.set_text(str(len(fav_model)))
+                self._bouquets_view.grab_focus()
+                yield True
+                return
+
         if len(services) > self.FAV_FACTOR * 20:
             self._bouquets_view.set_sensitive(False)
             yield True
 
         self._fav_view.set_model(None)
-        self._fav_model.clear()
+        self._fav_model = self.create_fav_model()
+        self._fav_bq = (key, services)
 
         num = 0
         for srv_id in services:
@@ -1526,14 +1609,38 @@ class Application(Gtk.Application):
 
                 self._fav_model.append((0 if is_marker else num, srv.coded, ex_srv_name if ex_srv_name else srv.service,
                                         srv.locked, srv.hide, srv_type, srv.pos, srv.fav_id,
-                                        self._picons.get(srv.picon_id, None), None, background))
+                                        None, None, background))
 
         yield True
         self._fav_view.set_model(self._fav_model)
+        self._fav_count_label.set_text(str(len(self._fav_model)))
         self._bouquets_view.set_sensitive(True)
         self._bouquets_view.grab_focus()
         yield True
 
+    def create_fav_model(self):
+        """ Returns a new empty model with the same columns as the fav model. """
+        model = Gtk.ListStore(*(self._fav_model.get_column_type(c) for c in range(self._fav_model.get_n_columns())))
+        Gtk.Buildable.set_name(model, self.FAV_MODEL_NAME)
+        model.connect("row-deleted", self.on_model_changed)
+        model.connect("row-inserted", self.on_model_changed)
+        return model
+
+    def cache_fav_model(self):
+        """ Keeps the current fav model with the versions of the data it corresponds to. """
+        if self._fav_bq:
+            key, services = self._fav_bq
+            if self._bouquets.get(key, None) is services:
+                self._fav_models[key] = (self._fav_model, services, services.version, self._services.version)
+                self._fav_models.move_to_end(key)
+                while len(self._fav_models) > self.FAV_CACHE_SIZE:
+                    self._fav_models.popitem(last=False)
+
+    def clear_fav_model(self):
+        """ Clears the current fav model [it's no longer consistent with the bouquet]. """
+        self._fav_bq = None
+        self._fav_model.clear()
+
     def check_bouquet_selection(self):
         """ Checks and returns bouquet if selected """
         if not self._bq_selected:
@@ -1747,29 +1854,17 @@ class Application(Gtk.Application):
         if model_name == self.FAV_MODEL_NAME:
             self._fav_count_label.set_text(str(len(model)))
         elif model_name == self.SERVICE_MODEL_NAME:
-            self.update_services_counts(len(model))
+            self.update_services_counts()
         elif model_name == self.BQ_MODEL_NAME:
             self._bouquets_count_label.set_text(str(len(self._bouquets.keys())))
 
-    @lru_cache(maxsize=1)
-    def update_services_counts(self, size=0):
-        """ Updates counters for services. May be temporary! """
-        tv_count = 0
-        radio_count = 0
-        data_count = 0
-
-        for ch in self._services.values():
-            ch_type = ch.service_type
-            if ch_type in self._TV_TYPES:
-                tv_count += 1
-            elif ch_type == "Radio":
-                radio_count += 1
-            elif ch_type == "Data":
-                data_count += 1
-
+    def update_services_counts(self):
+        """ Updates counters for services [from the facet counts maintained by the services]. """
+        facets = self._services.facets
+        tv_count = sum(facets.get_count("type", t) for t in self._TV_TYPES)
         self._tv_count_label.set_text(str(tv_count))
-        self._radio_count_label.set_text(str(radio_count))
-        self._data_count_label.set_text(str(data_count))
+        self._radio_count_label.set_text(str(facets.get_count("type", "Radio")))
+        self._data_count_label.set_text(str(facets.get_count("type", "Data")))
 
     def on_insert_marker(self, view, m_type=BqServiceType.MARKER):
         """ Inserts marker into bouquet services list. """
@@ -1846,6 +1941,38 @@ class Application(Gtk.Application):
             gen = self.remove_favs(response, self._fav_model)
             GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
 
+    @run_idle
+    def on_sort_by_stream_health(self, action, value=None):
+        """ Sorts IPTV streams of the current bouquet by the deep check results.
+
+            Available streams with the lower latency and the higher bitrate go first.
+            The positions of the other services and markers are not changed.
+        """
+        iptv_rows = list(filter(lambda r: r[Column.FAV_TYPE] == BqServiceType.IPTV.value, self._fav_model))
+        if not iptv_rows:
+            self.show_error_dialog("This list does not contains IPTV streams!")
+            return
+
+        bq = self._bouquets.get(self._bq_selected, None)
+        if not bq:
+            return
+
+        msg = "Are you sure you want to change the order\n\t of services in this bouquet?"
+        if show_dialog(DialogType.QUESTION, self._main_window, msg) != Gtk.ResponseType.OK:
+            return
+
+        dialog = SearchUnavailableDialog(self._main_window, self._fav_model, bq, iptv_rows, self._s_type, deep=True)
+        if dialog.show() is False:
+            return
+
+        results = dialog.results
+        rows = sorted(map(lambda r: r[:], iptv_rows),
+                      key=lambda r: StreamsChecker.get_health_key(results.get(get_iptv_url(r, self._s_type), None)))
+        for s_row, row in zip(rows, iptv_rows):
+            self._fav_model.set_row(row.iter, s_row)
+            bq[int(str(row.path))] = s_row[Column.FAV_ID]
+        self.update_fav_num_column(self._fav_model)
+
     # ****************** EPG  **********************#
 
     def on_epg_list_configuration(self, action, value=None):
@@ -1879,20 +2006,26 @@ class Application(Gtk.Application):
             self.show_error_dialog("No m3u file is selected!")
             return
 
-        channels = parse_m3u(response, self._s_type)
-
-        if channels and self._bq_selected:
-            self.append_imported_services(channels)
+        if self._bq_selected:
+            # The file is read in batches along with the appending.
+            gen = self.append_imported_batches(iter_m3u(response, self._s_type))
+            GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
 
     def append_imported_services(self, services):
+        gen = self.append_imported_batches((services,))
+        GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
+
+    def append_imported_batches(self, batches):
+        """ Appends the services lists (batches) to the current bouquet. """
         bq_services = self._bouquets.get(self._bq_selected)
-        self._fav_model.clear()
-        for srv in services:
-            self._services[srv.fav_id] = srv
-            bq_services.append(srv.fav_id)
+        self.clear_fav_model()
+        for services in batches:
+            for srv in services:
+                self._services[srv.fav_id] = srv
+            bq_services.extend(srv.fav_id for srv in services)
+            yield True
 
-        gen = self.update_bouquet_services(self._fav_model, None, self._bq_selected)
-        GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
+        yield from self.update_bouquet_services(self._fav_model, None, self._bq_selected)
 
     @run_idle
     def on_export_to_m3u(self, action, value=None):
@@ -1918,6 +2051,48 @@ class Application(Gtk.Application):
         else:
             show_dialog(DialogType.INFO, self._main_window, "Done!")
 
+    def on_export_all_to_m3u(self, action, value=None):
+        self.export_all_to_m3u()
+
+    def on_export_all_to_one_m3u(self, action, value=None):
+        self.export_all_to_m3u(merge=True)
+
+    @run_idle
+    def export_all_to_m3u(self, merge=False):
+        """ Exports all bouquets with IPTV streams [in a single pass over the bouquets]. """
+        i_types = (BqServiceType.IPTV.value, BqServiceType.MARKER.value)
+        iptv_type = BqServiceType.IPTV.value
+        bouquets, names = [], set()
+
+        for bq_key, services in self._bouquets.items():
+            srvs = [s for s in map(self._services.get, services) if s and s.service_type in i_types]
+            if not any(s.service_type == iptv_type for s in srvs):
+                continue
+
+            ex_services = self._extra_bouquets.get(bq_key, None) or {}
+            bq_services = [BouquetService(ex_services.get(s.fav_id, s.service),
+                                          BqServiceType(s.service_type), s.fav_id, 0) for s in srvs]
+            name, sep, bq_type = bq_key.rpartition(":")
+            # Bouquets with the same name [e.g. tv and radio] are saved to different files.
+            name = "{}_{}".format(name, bq_type) if name in names else name
+            names.add(name)
+            bouquets.append(Bouquet(name, bq_type, bq_services, None, None))
+
+        if not bouquets:
+            self.show_error_dialog("This list does not contains IPTV streams!")
+            return
+
+        response = show_dialog(DialogType.CHOOSER, self._main_window, settings=self._settings)
+        if response in (Gtk.ResponseType.CANCEL, Gtk.ResponseType.DELETE_EVENT):
+            return
+
+        try:
+            export_all_to_m3u(response, bouquets, self._s_type, merge)
+        except Exception as e:
+            self.show_error_dialog(str(e))
+        else:
+            show_dialog(DialogType.INFO, self._main_window, "Done!")
+
     def on_import_bouquet(self, action, value=None, file_path=None):
         model, paths = self._bouquets_view.get_selection().get_selected_rows()
         if not paths:
@@ -2405,6 +2580,7 @@ class Application(Gtk.Application):
         action.set_state(value)
         if value:
             self.update_filter_sat_positions()
+            self.update_filter_counts()
             self._filter_entry.grab_focus()
         else:
             self.filter_set_default()
@@ -2420,37 +2596,29 @@ class Application(Gtk.Application):
 
     def init_sat_positions(self):
         self._sat_positions.clear()
-        first = (self._filter_sat_positions_model[0][0],)
+        first = (self._filter_sat_positions_model[0][0], None)
         self._filter_sat_positions_model.clear()
         self._filter_sat_positions_model.append(first)
         self._filter_sat_positions_box.set_active(0)
 
     def update_sat_positions(self):
-        """ Updates positions values for the filtering function """
+        """ Updates positions values for the filtering function.
+
+            The positions are taken from the position facet of the services [only the distinct values are read].
+        """
         self._sat_positions.clear()
-        sat_positions = set()
+        positions = set(filter(None, self._services.facets.get_values("pos")))
 
         if self._s_type is SettingsType.ENIGMA_2:
-            terrestrial = False
-            cable = False
-
-            for srv in self._services.values():
-                tr_type = srv.transponder_type
-                if tr_type == "s" and srv.pos:
-                    sat_positions.add(float(srv.pos))
-                elif tr_type == "t":
-                    terrestrial = True
-                elif tr_type == "c":
-                    cable = True
-
-            if terrestrial:
-                self._sat_positions.append("T")
-            if cable:
-                self._sat_positions.append("C")
-        elif self._s_type is SettingsType.NEUTRINO_MP:
-            list(map(lambda s: sat_positions.add(float(s.pos)), filter(lambda s: s.pos, self._services.values())))
-
-        self._sat_positions.extend(map(str, sorted(sat_positions)))
+            # Terrestrial and cable services have "T" and "C" as position.
+            for pos in ("T", "C"):
+                if pos in positions:
+                    positions.discard(pos)
+                    self._sat_positions.append(pos)
+        elif self._s_type is not SettingsType.NEUTRINO_MP:
+            positions.clear()
+
+        self._sat_positions.extend(map(str, sorted(set(map(float, positions)))))
         if self._filter_bar.is_visible():
             self.update_filter_sat_positions()
 
@@ -2458,7 +2626,7 @@ class Application(Gtk.Application):
     def update_filter_sat_positions(self):
         model = self._filter_sat_positions_model
         if len(model) < 2:
-            list(map(self._filter_sat_positions_model.append, map(lambda x: (str(x),), self._sat_positions)))
+            list(map(self._filter_sat_positions_model.append, map(lambda x: (str(x), None), self._sat_positions)))
         else:
             selected = self._filter_sat_positions_box.get_active_id()
             active = self._filter_sat_positions_box.get_active()
@@ -2467,34 +2635,58 @@ class Application(Gtk.Application):
 
             if active != 0 and selected not in self._sat_positions:
                 self._filter_sat_positions_box.set_active(0)
+        self.update_filter_counts()
+
+    def update_filter_counts(self):
+        """ Shows the numbers of the services next to the types and positions in the filter. """
+        facets = self._services.facets
+        for model, name in ((self._filter_types_model, "type"), (self._filter_sat_positions_model, "pos")):
+            counts = facets.get_counts(name)
+            for index, row in enumerate(model):
+                if index:
+                    row[1] = str(counts.get(row[0], 0))
 
     @run_with_delay(1)
     def on_filter_changed(self, item):
-        GLib.idle_add(self._services_model_filter.refilter, priority=GLib.PRIORITY_LOW)
+        GLib.idle_add(self.refilter_services, priority=GLib.PRIORITY_LOW)
+
+    def refilter_services(self):
+        """ Reads the state of the filter elements once and refilters the services. """
+        self._filter_text = self._filter_entry.get_text()
+        self._filter_version = None
+        self._filter_type = self._filter_types_box.get_active_id() if self._filter_types_box.get_active() > 0 else None
+        pos_active = self._filter_sat_positions_box.get_active() > 0
+        self._filter_pos = self._filter_sat_positions_box.get_active_id() if pos_active else None
+        self._filter_free = self._filter_only_free_button.get_active()
+        self._services_model_filter.refilter()
+        self.update_filter_counts()
+
+    def get_filter_matches(self):
+        """ Returns the set of fav ids of the services matching the filter or None if the filter is empty.
+
+            The facets sets are intersected and then the precomputed texts of the services are searched.
+            The matches are computed again only after the changes of the filter or services.
+        """
+        texts, facets = self._services.texts, self._services.facets
+        version = (texts.version, facets.version)
+        if self._filter_version != version:
+            matches = facets.select(type=self._filter_type, pos=self._filter_pos, free=self._filter_free or None)
+            txt = self._filter_text.upper()
+            if txt:
+                if matches is None:
+                    matches = set(texts.search(txt))
+                else:
+                    matches = {k for k in matches if txt in texts.get(k, "")}
+            self._filter_matches = matches
+            self._filter_version = version
+        return self._filter_matches
 
     def services_filter_function(self, model, itr, data):
         if self._services_model_filter is None or self._services_model_filter == "None":
             return True
         else:
-            r_txt = str(model.get(itr, Column.SRV_SERVICE, Column.SRV_PACKAGE, Column.SRV_TYPE, Column.SRV_SSID,
-                                  Column.SRV_FREQ, Column.SRV_RATE, Column.SRV_POL, Column.SRV_FEC, Column.SRV_SYSTEM,
-                                  Column.SRV_POS)).upper()
-            txt = self._filter_entry.get_text().upper() in r_txt
-            type_active = self._filter_types_box.get_active() > 0
-            pos_active = self._filter_sat_positions_box.get_active() > 0
-            free = not model.get(itr, Column.SRV_CODED)[0] if self._filter_only_free_button.get_active() else True
-
-            if type_active and pos_active:
-                active_id = self._filter_types_box.get_active_id() == model.get(itr, Column.SRV_TYPE)[0]
-                pos = self._filter_sat_positions_box.get_active_id() == model.get(itr, Column.SRV_POS)[0]
-                return active_id and pos and txt and free
-            elif type_active:
-                return self._filter_types_box.get_active_id() == model.get(itr, Column.SRV_TYPE)[0] and txt and free
-            elif pos_active:
-                pos = self._filter_sat_positions_box.get_active_id() == model.get(itr, Column.SRV_POS)[0]
-                return pos and txt and free
-
-            return txt and free
+            matches = self.get_filter_matches()
+            return matches is None or model.get_value(itr, Column.SRV_FAV_ID) in matches
 
     def on_search_toggled(self, action, value):
         if self._app_info_box.get_visible():
@@ -2653,18 +2845,30 @@ class Application(Gtk.Application):
     # ***************** Picons *********************#
 
     def on_picons_manager_show(self, action, value=None):
-        ids = {}
-        if self._s_type is SettingsType.ENIGMA_2:
-            for r in self._services_model:
-                data = r[Column.SRV_PICON_ID].split("_")
-                ids["{}:{}:{}".format(data[3], data[5], data[6])] = r[Column.SRV_PICON_ID]
-
-        PiconsDialog(self._main_window, self._settings, ids, self._sat_positions, self).show()
+        PiconsDialog(self._main_window, self._settings, self._services.picon_ids, self._sat_positions, self).show()
 
     @run_task
     def update_picons(self):
         update_picons_data(self._settings.picons_local_path, self._picons)
-        append_picons(self._picons, self._services_model)
+        GLib.idle_add(self._services_view.queue_draw)
+        GLib.idle_add(self._fav_view.queue_draw)
+
+    def on_view_adjustment_changed(self, adjustment, view):
+        if view not in self._picons_pending:
+            self._picons_pending.add(view)
+            GLib.idle_add(self.update_view_picons, view, priority=GLib.PRIORITY_LOW)
+
+    def update_view_picons(self, view):
+        self._picons_pending.discard(view)
+        get_picon_id = self.get_srv_picon_id if view is self._services_view else self.get_fav_picon_id
+        prefetch_visible_picons(view, self._picons, get_picon_id)
+
+    def get_srv_picon_id(self, model, itr):
+        return model.get_value(itr, Column.SRV_PICON_ID)
+
+    def get_fav_picon_id(self, model, itr):
+        srv = self._services.get(model.get_value(itr, Column.FAV_ID), None)
+        return srv.picon_id if srv else None
 
     def on_assign_picon(self, view, src_path=None, dst_path=None):
         return assign_picons(self.get_target_view(view), self._services_view, self._fav_view, self._main_window,
@@ -2681,7 +2885,17 @@ class Application(Gtk.Application):
         if show_dialog(DialogType.QUESTION, self._main_window) == Gtk.ResponseType.CANCEL:
             return
 
-        remove_all_unused_picons(self._settings, self._picons, self._services.values())
+        remove_all_unused_picons(self._settings, self._picons, self._services.picon_ids)
+
+    def on_restore_picons(self, item):
+        """ Restores the picons of the last removal. """
+        try:
+            restored = restore_picons(self._settings)
+        except (OSError, ValueError) as e:
+            self.show_error_dialog(str(e))
+        else:
+            if restored:
+                self.update_picons()
 
     def get_target_view(self, view):
         return ViewTarget.SERVICES if Gtk.Buildable.get_name(view) == "services_tree_view" else ViewTarget.FAV
@@ -2733,17 +2947,15 @@ class Application(Gtk.Application):
         show_dialog(DialogType.ERROR, self._main_window, message)
 
     def is_data_saved(self):
-        if self._data_hash != 0 and self._data_hash != self.get_data_hash():
+        if self._saved_version is not None and self._saved_version != self.get_data_version():
             msg = "There are unsaved changes.\n\n\t Save them now?"
             resp = show_dialog(DialogType.QUESTION, self._main_window, msg, action_type=Gtk.ButtonsType.YES_NO)
             return resp != Gtk.ResponseType.YES
         return True
 
-    def get_data_hash(self):
-        """ Returns the sum of all data hash. """
-        return sum(map(hash, map(frozenset, (self._services.items(),
-                                             self._bouquets.keys(),
-                                             map(tuple, self._bouquets.values())))))
+    def get_data_version(self):
+        """ Returns the current version of the data [incremented on each change of services or bouquets]. """
+        return self._services.version + self._bouquets.version
 
     # ******************* Properties ***********************#
 
@@ -2767,6 +2979,10 @@ class Application(Gtk.Application):
     def current_services(self):
         return self._services
 
+    @property
+    def picons(self):
+        return self._picons
+
     @property
     def picons_buffer(self):
         """ Returns a copy and clears the current buffer. """
@@ -1,18 +1,29 @@
 """ Helper module for the ui. """
+import json
 import os
 import shutil
+import tempfile
+from collections import OrderedDict, defaultdict, Counter
+from datetime import datetime
+from threading import Lock
 from urllib.parse import unquote
 
 from gi.repository import GdkPixbuf, GLib
 
-from app.commons import run_task
+from app.commons import run_task, log
 from app.eparser import Service
 from app.eparser.ecommons import Flag, BouquetService, Bouquet, BqType
 from app.eparser.enigma.bouquets import BqServiceType, to_bouquet_id
 from app.settings import SettingsType
+from app.tools.picons import PiconIds
 from .dialogs import show_dialog, DialogType, get_chooser_dialog, WaitDialog
+from .search import TextIndex, FacetIndex
+from .thumbnails import ThumbnailsCache
 from .uicommons import ViewTarget, BqGenType, Gtk, Gdk, HIDE_ICON, LOCKED_ICON, KeyboardKey, Column
 
+_PICONS_CACHE_SIZE = 2048
+_PICONS_MANIFEST = "manifest.json"
+
 
 # ***************** Markers *******************#
 
@@ -347,26 +358,399 @@ def scroll_to(index, view, paths=None):
     selection.select_path(index)
 
 
+# ***************** Services *********************#
+
+class Services(dict):
+    """ Services by fav id with the index of their picon ids, the search texts and the filter facets.
+
+        The version is incremented on each change.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+        self.picon_ids = PiconIds()
+        self.texts = TextIndex()
+        self.facets = FacetIndex(pos=lambda s: s.pos, type=lambda s: s.service_type, free=lambda s: not s.coded)
+
+    def __setitem__(self, fav_id, srv):
+        old_srv = self.get(fav_id, None)
+        if old_srv:
+            self.picon_ids.remove(old_srv.picon_id, fav_id)
+            self.facets.remove(fav_id, old_srv)
+        super().__setitem__(fav_id, srv)
+        self.version += 1
+        self.picon_ids.add(srv.picon_id, fav_id)
+        self.facets.add(fav_id, srv)
+        self.texts[fav_id] = self.get_search_text(srv)
+
+    def __delitem__(self, fav_id):
+        self.pop(fav_id)
+
+    def pop(self, fav_id, *args):
+        srv = self.get(fav_id, None)
+        if srv:
+            self.version += 1
+            self.picon_ids.remove(srv.picon_id, fav_id)
+            self.facets.remove(fav_id, srv)
+            self.texts.pop(fav_id, None)
+        return super().pop(fav_id, *args)
+
+    def update(self, *args, **kwargs):
+        for fav_id, srv in dict(*args, **kwargs).items():
+            self[fav_id] = srv
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+        self.picon_ids.clear()
+        self.texts.clear()
+        self.facets.clear()
+
+    @staticmethod
+    def get_search_text(srv):
+        """ Returns the text of the searchable fields [the same as the filtered columns]. """
+        return "\t".join(str(v) for v in (srv.service, srv.package, srv.service_type, srv.ssid, srv.freq, srv.rate,
+                                           srv.pol, srv.fec, srv.system, srv.pos) if v is not None)
+
+
+class BouquetServices(list):
+    """ Fav ids of the bouquet services.
+
+        Increments its own version and the version of the owner on each change
+        and passes the added and removed fav ids to the owner [for the reverse index].
+    """
+
+    def __init__(self, owner, services=()):
+        super().__init__(services)
+        self._owner = owner
+        self.version = 0
+        self.key = None  # Bouquet id in the owner.
+
+    @property
+    def owner(self):
+        return self._owner
+
+    def changed(self, added=(), removed=()):
+        self.version += 1
+        self._owner.on_services_changed(self, added, removed)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            removed, added = self[index], value
+        else:
+            removed, added = (self[index],), (value,)
+        super().__setitem__(index, value)
+        self.changed(added, removed)
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else (self[index],)
+        super().__delitem__(index)
+        self.changed(removed=removed)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def append(self, fav_id):
+        super().append(fav_id)
+        self.changed((fav_id,))
+
+    def extend(self, fav_ids):
+        fav_ids = list(fav_ids)
+        super().extend(fav_ids)
+        self.changed(fav_ids)
+
+    def insert(self, index, fav_id):
+        super().insert(index, fav_id)
+        self.changed((fav_id,))
+
+    def remove(self, fav_id):
+        super().remove(fav_id)
+        self.changed(removed=(fav_id,))
+
+    def pop(self, *args):
+        fav_id = super().pop(*args)
+        self.changed(removed=(fav_id,))
+        return fav_id
+
+    def clear(self):
+        removed = list(self)
+        super().clear()
+        self.changed(removed=removed)
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.changed()
+
+    def reverse(self):
+        super().reverse()
+        self.changed()
+
+
+class BouquetsStore(dict):
+    """ Bouquets services by bouquet id.
+
+        The version is incremented on each change of the bouquets and their services.
+        The reverse index [fav id -> numbers of the entries by bouquet id] is updated
+        only for the added and removed entries.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+        self._refs = defaultdict(Counter)
+
+    def __setitem__(self, bq_id, services):
+        if not isinstance(services, BouquetServices) or services.owner is not self:
+            services = BouquetServices(self, services)
+        old_services = self.get(bq_id, None)
+        if old_services is not None:
+            self.detach(old_services)
+        self.detach(services)
+        super().__setitem__(bq_id, services)
+        services.key = bq_id
+        self.add_refs(bq_id, services)
+        self.version += 1
+
+    def __delitem__(self, bq_id):
+        self.pop(bq_id)
+
+    def pop(self, bq_id, *args):
+        services = super().pop(bq_id, *args)
+        if isinstance(services, BouquetServices) and services.key == bq_id:
+            self.version += 1
+            self.detach(services)
+        return services
+
+    def setdefault(self, bq_id, services=None):
+        if bq_id not in self:
+            self[bq_id] = services or []
+        return self[bq_id]
+
+    def update(self, *args, **kwargs):
+        for bq_id, services in dict(*args, **kwargs).items():
+            self[bq_id] = services
+
+    def clear(self):
+        for services in self.values():
+            services.key = None
+        super().clear()
+        self._refs.clear()
+        self.version += 1
+
+    def on_services_changed(self, services, added, removed):
+        self.version += 1
+        if services.key is not None:
+            self.remove_refs(services.key, removed)
+            self.add_refs(services.key, added)
+
+    def detach(self, services):
+        """ Removes the entries of the services from the reverse index. """
+        if services.key is not None:
+            self.remove_refs(services.key, services)
+            services.key = None
+
+    def add_refs(self, bq_id, fav_ids):
+        for fav_id in fav_ids:
+            self._refs[fav_id][bq_id] += 1
+
+    def remove_refs(self, bq_id, fav_ids):
+        for fav_id in fav_ids:
+            refs = self._refs.get(fav_id, None)
+            if refs is not None:
+                refs[bq_id] -= 1
+                if refs[bq_id] <= 0:
+                    del refs[bq_id]
+                if not refs:
+                    del self._refs[fav_id]
+
+    def get_bouquets(self, fav_id):
+        """ Returns the ids of the bouquets containing the service. """
+        return list(self._refs.get(fav_id, ()))
+
+    def get_positions(self, fav_id):
+        """ Returns list of (bouquet id, positions of the service in the bouquet).
+
+            Only the bouquets containing the service are read.
+        """
+        return [(bq_id, [i for i, f_id in enumerate(self[bq_id]) if f_id == fav_id])
+                for bq_id in self.get_bouquets(fav_id)]
+
+    def replace(self, fav_id, new_fav_id):
+        """ Replaces the service in all bouquets containing it. """
+        for bq_id, positions in self.get_positions(fav_id):
+            services = self[bq_id]
+            for index in positions:
+                services[index] = new_fav_id
+
+
 # ***************** Picons *********************#
 
+class PiconsCache:
+    """ Lazy, size-bounded cache of the picons pixbufs.
+
+        Only the names of the picon files are read on load.
+        Pixbufs are loaded on demand [from the persistent thumbnails cache]
+        and kept in LRU order by (picon id, size).
+    """
+
+    def __init__(self, max_size=_PICONS_CACHE_SIZE, size=32):
+        self._path = ""
+        self._size = size
+        self._max_size = max_size
+        self._files = set()
+        self._pixbufs = OrderedDict()
+        self._lock = Lock()
+        # The latest prefetch request [picon ids, size] for the single background worker.
+        self._prefetch_request = None
+        self._prefetching = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """ Reads the names of the picon files. """
+        files = set(os.listdir(path)) if os.path.isdir(path) else set()
+        ThumbnailsCache.save_all()
+        with self._lock:
+            self._path = path
+            self._files = files
+            self._pixbufs.clear()
+
+    def get(self, picon_id, default=None, size=None):
+        if picon_id not in self._files:
+            return default
+
+        key = (picon_id, size or self._size)
+        with self._lock:
+            pixbuf = self._pixbufs.get(key)
+            if pixbuf:
+                self._pixbufs.move_to_end(key)
+                self.hits += 1
+                return pixbuf
+            self.misses += 1
+
+        pixbuf = ThumbnailsCache.get_instance(self._path, key[1], key[1]).get(picon_id)
+        if not pixbuf:
+            return default
+        self.put(key, pixbuf)
+        return pixbuf
+
+    def put(self, key, pixbuf):
+        with self._lock:
+            self._pixbufs[key] = pixbuf
+            self._pixbufs.move_to_end(key)
+            if len(self._pixbufs) > self._max_size:
+                self._pixbufs.popitem(last=False)
+
+    def prefetch(self, picon_ids, size=None):
+        """ Decodes the given picons in the background.
+
+            The requests are handled by one worker. A pending request is replaced by the newer one.
+        """
+        with self._lock:
+            self._prefetch_request = (picon_ids, size)
+            if self._prefetching:
+                return
+            self._prefetching = True
+        self.run_prefetch()
+
+    @run_task
+    def run_prefetch(self):
+        while True:
+            with self._lock:
+                request, self._prefetch_request = self._prefetch_request, None
+                if not request:
+                    self._prefetching = False
+                    return
+
+            picon_ids, size = request
+            for p_id in picon_ids:
+                if self._prefetch_request:
+                    break  # The range is outdated.
+                self.get(p_id, size=size)
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._pixbufs.clear()
+            self.hits = self.misses = 0
+
+    def __getitem__(self, picon_id):
+        pixbuf = self.get(picon_id)
+        if pixbuf is None:
+            raise KeyError(picon_id)
+        return pixbuf
+
+    def __setitem__(self, picon_id, pixbuf):
+        """ Adds a new picon or removes it if the pixbuf is None. """
+        with self._lock:
+            for key in [k for k in self._pixbufs if k[0] == picon_id]:
+                del self._pixbufs[key]
+            if pixbuf is None:
+                self._files.discard(picon_id)
+            else:
+                self._files.add(picon_id)
+        if pixbuf is not None:
+            self.put((picon_id, self._size), pixbuf)
+
+    def remove(self, picon_ids):
+        """ Removes the given picons [batch]. """
+        picon_ids = set(picon_ids)
+        with self._lock:
+            self._files.difference_update(picon_ids)
+            for key in [k for k in self._pixbufs if k[0] in picon_ids]:
+                del self._pixbufs[key]
+
+    @property
+    def stats(self):
+        """ Returns the numbers of the hits, misses and cached pixbufs. """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cached": len(self._pixbufs)}
+
+    def __contains__(self, picon_id):
+        return picon_id in self._files
+
+    def __iter__(self):
+        return iter(list(self._files))
+
+    def __len__(self):
+        return len(self._files)
+
+    def __repr__(self):
+        return "PiconsCache(files={}, cached={}, hits={}, misses={})".format(len(self._files), len(self._pixbufs),
+                                                                            self.hits, self.misses)
+
+
 def update_picons_data(path, picons):
-    if not os.path.exists(path):
-        return
+    """ Updates the list of available picons. Pixbufs will be loaded on demand. """
+    picons.load(path)
+
+
+def set_picons_data_func(column, renderer, picons, get_picon_id):
+    """ Renders the picons of the column directly from the cache.
 
-    for file in os.listdir(path):
-        pf = get_picon_pixbuf(path + file)
-        if pf:
-            picons[file] = pf
+        The model picon column stays empty, so only the LRU of the cache holds the pixbufs.
+        @param get_picon_id: function that returns picon id for the row of the view model.
+    """
+    def picon_data_func(col, rend, model, itr, data):
+        rend.set_property("pixbuf", picons.get(get_picon_id(model, itr), None))
 
+    column.set_cell_data_func(renderer, picon_data_func)
 
-def append_picons(picons, model):
-    def append_picons_data(pcs, mod):
-        for r in mod:
-            mod.set_value(mod.get_iter(r.path), Column.SRV_PICON, pcs.get(r[Column.SRV_PICON_ID], None))
-            yield True
 
-    app = append_picons_data(picons, model)
-    GLib.idle_add(lambda: next(app, False), priority=GLib.PRIORITY_LOW)
+def prefetch_visible_picons(view, picons, get_picon_id):
+    """ Decodes the picons for the next page of the rows in the background. """
+    visible_range = view.get_visible_range()
+    if not visible_range:
+        return
+
+    model = view.get_model()
+    start, end = visible_range
+    start, end = start.get_indices()[0], end.get_indices()[0]
+    next_end = min(end + 1 + (end - start), len(model))
+    picons.prefetch([get_picon_id(model, model.get_iter(i)) for i in range(end + 1, next_end)])
 
 
 def assign_picons(target, srv_view, fav_view, transient, picons, settings, services, src_path=None, dst_path=None):
@@ -384,7 +768,6 @@ def assign_picons(target, srv_view, fav_view, transient, picons, settings, servi
         show_dialog(DialogType.ERROR, transient, text="No png file is selected!")
         return picons_files
 
-    p_pos = Column.SRV_PICON
     col_num = Column.SRV_FAV_ID if target is ViewTarget.SERVICES else Column.FAV_ID
     itrs = [model.get_iter(p) for p in paths]
 
@@ -407,32 +790,19 @@ def assign_picons(target, srv_view, fav_view, transient, picons, settings, servi
                 pass  # NOP
             else:
                 picons_files.append(picon_file)
-                picon = get_picon_pixbuf(picon_file)
-                picons[picon_id] = picon
-                model.set_value(itr, p_pos, picon)
-                if target is ViewTarget.SERVICES:
-                    set_picon(fav_id, fav_view.get_model(), picon, Column.FAV_ID, p_pos)
-                else:
-                    set_picon(fav_id, get_base_model(srv_view.get_model()), picon, Column.SRV_FAV_ID, p_pos)
+                picons[picon_id] = get_picon_pixbuf(picon_file)
 
+    srv_view.queue_draw()
+    fav_view.queue_draw()
     return picons_files
 
 
-def set_picon(fav_id, model, picon, fav_id_pos, picon_pos):
-    for row in model:
-        if row[fav_id_pos] == fav_id:
-            row[picon_pos] = picon
-            return True
-    return True
-
-
 def remove_picon(target, srv_view, fav_view, picons, settings):
     view = srv_view if target is ViewTarget.SERVICES else fav_view
     model, paths = view.get_selection().get_selected_rows()
 
     fav_ids = []
     picon_ids = []
-    picon_pos = Column.SRV_PICON  # picon position is equal for services and fav
 
     itrs = [model.get_iter(p) for p in paths]
 
@@ -442,9 +812,7 @@ def remove_picon(target, srv_view, fav_view, picons, settings):
         model = get_base_model(model)
 
     for itr in itrs:
-        model.set_value(itr, picon_pos, None)
         if target is ViewTarget.SERVICES:
-            fav_ids.append(model.get_value(itr, Column.SRV_FAV_ID))
             picon_ids.append(model.get_value(itr, Column.SRV_PICON_ID))
         else:
             srv_type, fav_id = model.get(itr, Column.FAV_TYPE, Column.FAV_ID)
@@ -453,18 +821,15 @@ def remove_picon(target, srv_view, fav_view, picons, settings):
             else:
                 fav_ids.append(fav_id)
 
-    fav_id_column = Column.FAV_ID if target is ViewTarget.SERVICES else Column.SRV_FAV_ID
-
-    def remove(md, path, it):
-        if md.get_value(it, fav_id_column) in fav_ids:
-            md.set_value(it, picon_pos, None)
-            if target is ViewTarget.FAV:
-                picon_ids.append(md.get_value(it, Column.SRV_PICON_ID))
-
-    fav_view.get_model().foreach(remove) if target is ViewTarget.SERVICES else get_base_model(
-        srv_view.get_model()).foreach(remove)
+    if target is ViewTarget.FAV:
+        fav_ids = set(fav_ids)
+        for row in get_base_model(srv_view.get_model()):
+            if row[Column.SRV_FAV_ID] in fav_ids:
+                picon_ids.append(row[Column.SRV_PICON_ID])
 
     remove_picons(settings, picon_ids, picons)
+    srv_view.queue_draw()
+    fav_view.queue_draw()
 
 
 def copy_picon_reference(target, view, services, clipboard, transient):
@@ -488,21 +853,88 @@ def copy_picon_reference(target, view, services, clipboard, transient):
             show_dialog(DialogType.ERROR, transient, "No reference is present!")
 
 
-def remove_all_unused_picons(settings, picons, services):
-    ids = {s.picon_id for s in services}
-    pcs = list(filter(lambda x: x not in ids, picons))
-    remove_picons(settings, pcs, picons)
+def remove_all_unused_picons(settings, picons, picon_ids):
+    remove_picons(settings, picon_ids.get_unused(picons), picons)
 
 
 def remove_picons(settings, picon_ids, picons):
-    pions_path = settings.picons_local_path
-    backup_path = settings.backup_local_path + "picons/"
-    os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+    """ Moves the picons to a new backup directory with a manifest [for undo].
+
+        Returns the backup directory path or None if there is nothing to remove.
+    """
+    picons_path = settings.picons_local_path
+    picons.remove(picon_ids)
+    picon_ids = [p for p in set(picon_ids) if os.path.isfile(picons_path + p)]
+    if not picon_ids:
+        return
+
+    backup_path = "{}picons/{}/".format(settings.backup_local_path, datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f"))
+    os.makedirs(backup_path)
+    # The manifest is written first to be able to restore the files after an incomplete removal.
+    write_picons_manifest(backup_path, picons_path, picon_ids)
     for p_id in picon_ids:
-        picons[p_id] = None
-        src = pions_path + p_id
-        if os.path.isfile(src):
-            shutil.move(src, backup_path + p_id)
+        try:
+            os.replace(picons_path + p_id, backup_path + p_id)
+        except OSError:
+            shutil.move(picons_path + p_id, backup_path + p_id)
+
+    return backup_path
+
+
+def write_picons_manifest(backup_path, picons_path, picon_ids):
+    with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=backup_path, delete=False) as f:
+        json.dump({"path": picons_path, "files": picon_ids}, f)
+    os.replace(f.name, backup_path + _PICONS_MANIFEST)
+
+
+def restore_picons(settings):
+    """ Restores the picons of the last removal. Returns the list of the restored picon ids. """
+    backup_path = settings.backup_local_path + "picons/"
+    try:
+        dirs = sorted(d.path for d in os.scandir(backup_path) if os.path.isfile(d.path + "/" + _PICONS_MANIFEST))
+    except OSError:
+        return []
+
+    if not dirs:
+        return []
+
+    path = dirs[-1] + "/"
+    with open(path + _PICONS_MANIFEST, encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    picons_path = manifest.get("path", settings.picons_local_path)
+    os.makedirs(picons_path, exist_ok=True)
+    restored, remaining = [], []
+    for p_id in manifest.get("files", []):
+        if not os.path.isfile(path + p_id):
+            continue
+        if os.path.exists(picons_path + p_id):
+            log("Picon [{}] is not restored: the file already exists.".format(p_id))
+            remaining.append(p_id)
+            continue
+        try:
+            try:
+                os.replace(path + p_id, picons_path + p_id)
+            except OSError:
+                shutil.move(path + p_id, picons_path + p_id)
+        except OSError as e:
+            log("Picon [{}] restoring error: {}".format(p_id, e))
+            remaining.append(p_id)
+        else:
+            restored.append(p_id)
+
+    if remaining:
+        # The backup is kept with the files that have not been restored.
+        write_picons_manifest(path, picons_path, remaining)
+        return restored
+
+    try:
+        os.remove(path + _PICONS_MANIFEST)
+        os.rmdir(path)
+    except OSError as e:
+        log("Picons backup [{}] cleanup error: {}".format(path, e))
+
+    return restored
 
 
 def is_only_one_item_selected(paths, transient):
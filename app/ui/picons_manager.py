@@ -1,37 +1,41 @@
+import concurrent.futures
+import multiprocessing
 import os
 import re
 import shutil
-import subprocess
-import tempfile
 from pathlib import Path
 from urllib.parse import urlparse, unquote
 
-from gi.repository import GLib, GdkPixbuf
+from gi.repository import GLib, GdkPixbuf, Gio
 
 from app.commons import run_idle, run_task, run_with_delay
-from app.connections import upload_data, DownloadType, download_data, remove_picons
+from app.connections import upload_data, DownloadType, download_data, remove_picons, PICONS_SUF
 from app.settings import SettingsType, Settings
-from app.tools.picons import PiconsParser, parse_providers, Provider, convert_to
+from app.tools.picons import (parse_providers, Provider, convert_to, resize_picons, PiconsFetcher,
+                              PiconsDownloader, find_duplicate_picons, link_duplicate_picons,
+                              get_picons_links_commands)
 from app.tools.satellites import SatellitesParser, SatelliteSource
 from .dialogs import show_dialog, DialogType, get_message
-from .main_helper import (update_entry_data, append_text_to_tview, scroll_to, on_popup_menu, get_base_model, set_picon,
-                          get_picon_pixbuf)
+from .main_helper import (update_entry_data, append_text_to_tview, scroll_to, on_popup_menu, get_base_model,
+                          get_picon_pixbuf, set_picons_data_func, prefetch_visible_picons)
+from .thumbnails import ThumbnailsCache, Thumbnails
 from .uicommons import Gtk, Gdk, UI_RESOURCES_PATH, TV_ICON, Column, KeyboardKey
 
 
 class PiconsDialog:
+    _RESIZE_CHUNK_SIZE = 32
+    _PICONS_FACTOR = 1000
+
     def __init__(self, transient, settings, picon_ids, sat_positions, app):
         self._picon_ids = picon_ids
         self._sat_positions = sat_positions
         self._app = app
-        self._TMP_DIR = tempfile.gettempdir() + "/"
-        self._BASE_URL = "www.lyngsat.com/packages/"
         self._PATTERN = re.compile(r"^https://www\.lyngsat\.com/[\w-]+\.html$")
         self._POS_PATTERN = re.compile(r"^\d+\.\d+[EW]?$")
-        self._current_process = None
+        self._fetcher = None
+        self._task_running = False
         self._terminate = False
         self._filter_binding = None
-        self._services = None
         self._current_picon_info = None
 
         handlers = {"on_receive": self.on_receive,
@@ -63,6 +67,8 @@ class PiconsDialog:
                     "on_selective_download": self.on_selective_download,
                     "on_selective_remove": self.on_selective_remove,
                     "on_local_remove": self.on_local_remove,
+                    "on_find_duplicates": self.on_find_duplicates,
+                    "on_link_duplicates": self.on_link_duplicates,
                     "on_picons_dest_view_realize": self.on_picons_dest_view_realize,
                     "on_satellites_view_realize": self.on_satellites_view_realize,
                     "on_satellite_selection": self.on_satellite_selection,
@@ -89,6 +95,17 @@ class PiconsDialog:
         self._picons_src_filter_model.set_visible_func(self.picons_src_filter_function)
         self._picons_dst_filter_model = builder.get_object("picons_dst_filter_model")
         self._picons_dst_filter_model.set_visible_func(self.picons_dst_filter_function)
+        # Picons are drawn from the thumbnails and loaded only for the visible rows
+        self._thumbnails = Thumbnails(72, 48)
+        self._picons_pending = set()
+        set_picons_data_func(builder.get_object("src_picon_column"), builder.get_object("picons_src_renderer"),
+                             self._thumbnails, self.get_picon_path)
+        set_picons_data_func(builder.get_object("dest_picon_column"), builder.get_object("picons_dest_renderer"),
+                             self._thumbnails, self.get_picon_path)
+        for view in (self._picons_src_view, self._picons_dest_view):
+            adjustment = view.get_vadjustment()
+            adjustment.connect("value-changed", self.on_view_adjustment_changed, view)
+            adjustment.connect("changed", self.on_view_adjustment_changed, view)
         self._explorer_src_path_button = builder.get_object("explorer_src_path_button")
         self._explorer_dest_path_button = builder.get_object("explorer_dest_path_button")
         self._expander = builder.get_object("expander")
@@ -169,7 +186,6 @@ class PiconsDialog:
         self._dialog.show()
 
     def on_picons_dest_view_realize(self, view):
-        self._services = {s.picon_id: s for s in self._app.current_services.values() if s.picon_id}
         self._explorer_dest_path_button.select_filename(self._settings.picons_local_path)
 
     def on_picons_src_changed(self, button):
@@ -189,33 +205,47 @@ class PiconsDialog:
         GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
 
     def update_picons(self, path, view, button):
-        p_model = view.get_model()
-        if not p_model:
+        """ Replaces the model of the view with a new one that contains only the file names.
+
+            Pixbufs are loaded when the rows become visible.
+        """
+        if not view.get_model():
             button.set_sensitive(True)
             return
 
-        model = get_base_model(p_model)
-        view.set_model(None)
-        factor = self._app.DEL_FACTOR
-
-        for index, itr in enumerate([row.iter for row in model]):
-            model.remove(itr)
-            if index % factor == 0:
-                yield True
-
-        for file in os.listdir(path):
+        model = Gtk.ListStore(GdkPixbuf.Pixbuf, str, str)
+        for index, file in enumerate(f for f in os.listdir(path) if f.endswith(PICONS_SUF)):
             if self._terminate:
                 return
 
-            p_path = "{}/{}".format(path, file)
-            p = self.get_pixbuf_at_scale(p_path, 72, 48, True)
-            if p:
-                yield model.append((p, file, p_path))
+            model.append((None, file, "{}/{}".format(path, file)))
+            if index % self._PICONS_FACTOR == 0:
+                yield True
+
+        filter_model = model.filter_new()
+        if view is self._picons_src_view:
+            filter_model.set_visible_func(self.picons_src_filter_function)
+            self._picons_src_filter_model = filter_model
+        else:
+            filter_model.set_visible_func(self.picons_dst_filter_function)
+            self._picons_dst_filter_model = filter_model
 
-        view.set_model(p_model)
+        view.set_model(Gtk.TreeModelSort(model=filter_model))
         button.set_sensitive(True)
         yield True
 
+    def on_view_adjustment_changed(self, adjustment, view):
+        if view not in self._picons_pending:
+            self._picons_pending.add(view)
+            GLib.idle_add(self.update_view_picons, view, priority=GLib.PRIORITY_LOW)
+
+    def update_view_picons(self, view):
+        self._picons_pending.discard(view)
+        prefetch_visible_picons(view, self._thumbnails, self.get_picon_path)
+
+    def get_picon_path(self, model, itr):
+        return model.get_value(itr, 2)
+
     def update_picons_from_file(self, view, uri):
         """ Adds picons in the view on dragging from file system. """
         path = Path(urlparse(unquote(uri)).path.strip())
@@ -226,9 +256,8 @@ class PiconsDialog:
         model = get_base_model(view.get_model())
 
         if path.is_file():
-            p = self.get_pixbuf_at_scale(f_path, 72, 48, True)
-            if p:
-                model.append((p, path.name, f_path))
+            if self._thumbnails.get(f_path):
+                model.append((None, path.name, f_path))
         elif path.is_dir():
             self._explorer_src_path_button.select_filename(f_path)
 
@@ -312,15 +341,14 @@ class PiconsDialog:
             paths = {r[1]: r.iter for r in dest_model}
 
             for p_path in picons:
-                p = self.get_pixbuf_at_scale(p_path, 72, 48, True)
-                if p:
+                self._thumbnails.remove(p_path)
+                if self._thumbnails.get(p_path):
                     p_name = Path(p_path).name
                     itr = paths.get(p_name, None)
-                    if itr:
-                        dest_model.set_value(itr, 0, p)
-                    else:
-                        itr = dest_model.append((p, p_name, p_path))
+                    if not itr:
+                        itr = dest_model.append((None, p_name, p_path))
                     scroll_to(dest_model.get_path(itr), self._picons_dest_view)
+            self._picons_dest_view.queue_draw()
 
     @run_idle
     def show_assign_info(self, fav_ids):
@@ -342,18 +370,18 @@ class PiconsDialog:
 
         uris = data.get_uris()
         if len(uris) == 2:
-            name, fav_id = self._current_picon_info
+            name = self._current_picon_info[0]
             src = urlparse(unquote(uris[0])).path
             dst = "{}/{}".format(urlparse(unquote(uris[1])).path, name)
             if src != dst:
                 shutil.copy(src, dst)
                 for row in get_base_model(self._picons_dest_view.get_model()):
                     if name == row[1]:
-                        row[0] = self.get_pixbuf_at_scale(row[-1], 72, 48, True)
+                        self._thumbnails.remove(row[-1])
+                        self._picons_dest_view.queue_draw()
                         img.set_from_pixbuf(self.get_pixbuf_at_scale(row[-1], 100, 60, True))
 
-                gen = self.update_picon_in_lists(dst, fav_id)
-                GLib.idle_add(lambda: next(gen, False), priority=GLib.PRIORITY_LOW)
+                self.update_picon_in_lists(dst, name)
 
     def on_send_button_drag_data_received(self, button, drag_context, x, y, data, info, time):
         path = self.get_path_from_uris(data)
@@ -375,11 +403,11 @@ class PiconsDialog:
         if len(uris) == 2:
             return Path(urlparse(unquote(uris[0])).path).resolve()
 
-    def update_picon_in_lists(self, dst, fav_id):
-        picon = get_picon_pixbuf(dst)
-        p_pos = Column.SRV_PICON
-        yield set_picon(fav_id, get_base_model(self._app.services_view.get_model()), picon, Column.SRV_FAV_ID, p_pos)
-        yield set_picon(fav_id, get_base_model(self._app.fav_view.get_model()), picon, Column.FAV_ID, p_pos)
+    def update_picon_in_lists(self, dst, picon_id):
+        """ Updates the picon in the cache of the main window [the lists are drawn from it]. """
+        self._app.picons[picon_id] = get_picon_pixbuf(dst)
+        self._app.services_view.queue_draw()
+        self._app.fav_view.queue_draw()
 
     # ******************** Download/Upload/Remove ************************* #
 
@@ -410,6 +438,35 @@ class PiconsDialog:
                 itr = filter_model.convert_iter_to_child_iter(model.convert_iter_to_child_iter(itr))
                 base_model.remove(itr)
 
+    def on_find_duplicates(self, item):
+        path = self._explorer_dest_path_button.get_filename()
+        if path:
+            self.run_func(lambda: self.find_duplicates(path))
+
+    def find_duplicates(self, path):
+        """ Reports the duplicates and the commands to replace them with symlinks on the receiver. """
+        self.show_info_message(get_message("Please, wait..."), Gtk.MessageType.INFO)
+        duplicates = find_duplicate_picons(path)
+        for original, dups in duplicates.items():
+            self.append_output("{}: {}\n".format(original, ", ".join(dups)))
+
+        count = sum(len(d) for d in duplicates.values())
+        if count:
+            commands = get_picons_links_commands(duplicates, self._settings.picons_path)
+            self.append_output("\n{}\n".format("\n".join(commands)))
+        self.show_info_message("{}: {}".format(get_message("Duplicates"), count), Gtk.MessageType.INFO)
+
+    def on_link_duplicates(self, item):
+        path = self._explorer_dest_path_button.get_filename()
+        if path and show_dialog(DialogType.QUESTION, self._dialog) == Gtk.ResponseType.OK:
+            self.run_func(lambda: self.link_duplicates(path), True)
+
+    def link_duplicates(self, path):
+        """ Keeps one copy of the identical picons locally [via hard links]. """
+        self.show_info_message(get_message("Please, wait..."), Gtk.MessageType.INFO)
+        freed = link_duplicate_picons(path, find_duplicate_picons(path))
+        self.show_info_message("{} {} KB".format(get_message("Done!"), freed // 1024), Gtk.MessageType.INFO)
+
     def on_send(self, item=None, files_filter=None, path=None):
         dest_path = path or self.check_dest_path()
         if not dest_path:
@@ -494,47 +551,51 @@ class PiconsDialog:
 
     @run_idle
     def on_load_providers(self, item):
+        if self.is_task_running():
+            self.show_dialog("The task is already running!", DialogType.ERROR)
+            return
+
         self._expander.set_expanded(True)
         self.on_info_bar_close()
         self._cancel_button.show()
-        url = self._url_entry.get_text()
-
-        try:
-            self._current_process = subprocess.Popen(["wget", "-pkP", self._TMP_DIR, url],
-                                                     stdout=subprocess.PIPE,
-                                                     stderr=subprocess.PIPE,
-                                                     universal_newlines=True)
-        except FileNotFoundError as e:
-            self._cancel_button.hide()
-            self.show_info_message(str(e), Gtk.MessageType.ERROR)
-        else:
-            GLib.io_add_watch(self._current_process.stderr, GLib.IO_IN, self.write_to_buffer)
-            model = self._providers_view.get_model()
-            model.clear()
-            self.append_providers(url, model)
+        model = self._providers_view.get_model()
+        model.clear()
+        self.append_providers(self._url_entry.get_text(), model)
 
     @run_task
     def append_providers(self, url, model):
-        self._current_process.wait()
+        self._terminate = False
+        self._task_running = True
+        self._fetcher = PiconsFetcher()
         try:
-            self._terminate = False
-            providers = parse_providers(self._TMP_DIR + url[url.find("w"):])
-        except FileNotFoundError:
-            pass  # NOP
-        else:
+            self.append_output("Loading: {}\n".format(url))
+            html = self._fetcher.get_text(url)
+            if html is None:
+                self.show_info_message(get_message("Error. Verify the data!"), Gtk.MessageType.ERROR)
+                return
+
+            providers = parse_providers(html, url)
             if providers:
+                logos = self._fetcher.get_all(p.logo for p in providers if p.logo)
                 for p in providers:
                     if self._terminate:
                         return
-                    model.append((self.get_pixbuf(p[0]) if p[0] else TV_ICON, *p[1:]))
+                    model.append((self.get_pixbuf(logos.get(p.logo)) if p.logo else TV_ICON, *p[1:]))
             self.update_receive_button_state()
         finally:
             GLib.idle_add(self._cancel_button.hide)
+            self._task_running = False
             self._terminate = False
 
-    def get_pixbuf(self, img_url):
-        return GdkPixbuf.Pixbuf.new_from_file_at_scale(filename=self._TMP_DIR + "www.lyngsat.com/" + img_url,
-                                                       width=48, height=48, preserve_aspect_ratio=True)
+    def get_pixbuf(self, data):
+        if not data:
+            return TV_ICON
+
+        stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+        try:
+            return GdkPixbuf.Pixbuf.new_from_stream_at_scale(stream, 48, 48, True, None)
+        except GLib.GError:
+            return TV_ICON
 
     def on_receive(self, item):
         self._cancel_button.show()
@@ -542,7 +603,7 @@ class PiconsDialog:
 
     @run_task
     def start_download(self):
-        if self._current_process.poll() is None:
+        if self.is_task_running():
             self.show_dialog("The task is already running!", DialogType.ERROR)
             return
 
@@ -557,11 +618,15 @@ class PiconsDialog:
                 scroll_to(prv.path, self._providers_view)
                 return
 
+        self._task_running = True
+        self._fetcher = PiconsFetcher()
+        downloader = PiconsDownloader(self._fetcher, self._picon_ids, self.get_picons_format())
+        self.show_info_message(get_message("Please, wait..."), Gtk.MessageType.INFO)
         try:
-            for prv in providers:
-                if self._terminate:
-                    return
-                self.process_provider(Provider(*prv))
+            downloader.download([Provider(*prv) for prv in providers], self._picons_dir_entry.get_text(),
+                                self.on_provider_done)
+            if self._terminate:
+                return
 
             if not self._resize_no_radio_button.get_active():
                 self.resize(self._picons_dir_entry.get_text())
@@ -569,48 +634,43 @@ class PiconsDialog:
                 self.show_info_message(get_message("Done!"), Gtk.MessageType.INFO)
         finally:
             GLib.idle_add(self._cancel_button.hide)
+            self._task_running = False
             self._terminate = False
 
-    def process_provider(self, prv):
-        url = prv.url
-        self.show_info_message(get_message("Please, wait..."), Gtk.MessageType.INFO)
-        self._current_process = subprocess.Popen(["wget", "-pkP", self._TMP_DIR, url],
-                                                 stdout=subprocess.PIPE,
-                                                 stderr=subprocess.PIPE,
-                                                 universal_newlines=True)
-        GLib.io_add_watch(self._current_process.stderr, GLib.IO_IN, self.write_to_buffer)
-        self._current_process.wait()
-        path = self._TMP_DIR + (url[url.find("//") + 2:] if prv.single else self._BASE_URL + url[url.rfind("/") + 1:])
-        PiconsParser.parse(path, self._picons_dir_entry.get_text(),
-                           self._TMP_DIR, prv, self._picon_ids, self.get_picons_format())
-
-    def write_to_buffer(self, fd, condition):
-        if condition == GLib.IO_IN:
-            char = fd.read(1)
-            self.append_output(char)
-            return True
-        return False
+    def on_provider_done(self, prv, saved, total):
+        self.append_output("{} [{}]: {}/{}\n".format(prv.name, prv.url, saved, total))
 
     @run_idle
-    def append_output(self, char):
-        append_text_to_tview(char, self._text_view)
+    def append_output(self, text):
+        append_text_to_tview(text, self._text_view)
 
-    @run_task
     def resize(self, path):
+        """ Resizes the picons in the worker processes. """
         self.show_info_message(get_message("Resizing..."), Gtk.MessageType.INFO)
 
         try:
-            from pathlib import Path
-            from PIL import Image
+            import PIL.Image
         except ImportError as e:
             self.show_info_message("{} {}".format(get_message("Conversion error."), e), Gtk.MessageType.ERROR)
         else:
             res = (220, 132) if self._resize_220_132_radio_button.get_active() else (100, 60)
-
-            for img_file in Path(path).glob("*.png"):
-                img = Image.open(img_file)
-                img = img.resize(res, Image.ANTIALIAS)
-                img.save(img_file, "PNG", optimize=True)
+            files = [str(f) for f in Path(path).glob("*.png")]
+            chunks = [files[i:i + self._RESIZE_CHUNK_SIZE] for i in range(0, len(files), self._RESIZE_CHUNK_SIZE)]
+            done = 0
+
+            # The workers are spawned [not forked] to avoid inheriting the state of the running threads.
+            context = multiprocessing.get_context("spawn")
+            with concurrent.futures.ProcessPoolExecutor(mp_context=context) as executor:
+                futures = {executor.submit(resize_picons, chunk, res): len(chunk) for chunk in chunks}
+                for future in concurrent.futures.as_completed(futures):
+                    if self._terminate:
+                        for f in futures:
+                            f.cancel()
+                        return
+                    future.result()
+                    done += futures[future]
+                    msg = "{} {}/{}".format(get_message("Resizing..."), done, len(files))
+                    self.show_info_message(msg, Gtk.MessageType.INFO)
 
             self.show_info_message(get_message("Done!"), Gtk.MessageType.INFO)
 
@@ -624,8 +684,8 @@ class PiconsDialog:
     def terminate_task(self):
         self._terminate = True
 
-        if self._current_process:
-            self._current_process.terminate()
+        if self._fetcher:
+            self._fetcher.cancel()
             self.show_info_message(get_message("The task is canceled!"), Gtk.MessageType.WARNING)
 
     def on_close(self, window, event):
@@ -645,9 +705,7 @@ class PiconsDialog:
 
     @run_task
     def clean_data(self):
-        path = self._TMP_DIR + "www.lyngsat.com"
-        if os.path.exists(path):
-            shutil.rmtree(path)
+        ThumbnailsCache.save_all()
 
     @run_task
     def run_func(self, func, update=False):
@@ -698,8 +756,10 @@ class PiconsDialog:
         if not active:
             self._picons_filter_entry.set_text("")
 
-    def on_fiter_srcs_toggled(self, filter_model):
-        """ Activates re-filtering for model when filter check-button has toggled. """
+    def on_fiter_srcs_toggled(self, button):
+        """ Activates re-filtering for the current model when filter check-button has toggled. """
+        is_src = button is self._src_filter_button
+        filter_model = self._picons_src_filter_model if is_src else self._picons_dst_filter_model
         GLib.idle_add(filter_model.refilter, priority=GLib.PRIORITY_LOW)
 
     def on_filter_services_switch(self, button, state):
@@ -744,9 +804,13 @@ class PiconsDialog:
 
             row = model[path][:]
             name, path = row[1], row[-1]
-            srv = self._services.get(row[1], None)
+            srv = self.get_service(row[1])
             self.update_picon_info(name, path, srv)
 
+    def get_service(self, picon_id):
+        fav_ids = self._picon_ids.get_fav_ids(picon_id)
+        return self._app.current_services.get(next(iter(fav_ids)), None) if fav_ids else None
+
     def update_picon_info(self, name=None, path=None, srv=None):
         self._picon_info_image.set_from_pixbuf(self.get_pixbuf_at_scale(path, 100, 60, True) if path else None)
         self._picon_info_label.set_text(self.get_service_info(srv))
@@ -809,7 +873,8 @@ class PiconsDialog:
                    dest_path=save_path,
                    s_type=SettingsType.ENIGMA_2,
                    callback=self.append_output,
-                   done_callback=lambda: self.show_info_message(get_message("Done!"), Gtk.MessageType.INFO))
+                   done_callback=lambda: self.show_info_message(get_message("Done!"), Gtk.MessageType.INFO),
+                   picon_ids=self._picon_ids)
 
     @run_idle
     def update_receive_button_state(self):
@@ -835,7 +900,7 @@ class PiconsDialog:
         return picon_format
 
     def is_task_running(self):
-        return self._current_process and self._current_process.poll() is None
+        return self._task_running
 
 
 if __name__ == "__main__":
@@ -1,4 +1,196 @@
 """ This is helper module for search features """
+from bisect import bisect_right
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+from gi.repository import GObject
+
+from .uicommons import Gtk
+
+
+class TextIndex:
+    """ Index of the normalized [upper-cased] texts by keys.
+
+        For the search, the texts are joined into a single blob [rebuilt lazily after changes]
+        which is scanned with str.find, and the found offsets are mapped to the keys.
+    """
+    _SEPARATOR = "\0"
+
+    def __init__(self):
+        self._texts = {}
+        self._keys = []
+        self._offsets = []
+        self._blob = None
+        self.version = 0
+
+    def __setitem__(self, key, text):
+        text = text.upper()
+        if self._texts.get(key, None) != text:
+            self._texts[key] = text
+            self.reset()
+
+    def __delitem__(self, key):
+        del self._texts[key]
+        self.reset()
+
+    def __contains__(self, key):
+        return key in self._texts
+
+    def __len__(self):
+        return len(self._texts)
+
+    def get(self, key, default=None):
+        return self._texts.get(key, default)
+
+    def pop(self, key, *args):
+        if key in self._texts:
+            self.reset()
+        return self._texts.pop(key, *args)
+
+    def clear(self):
+        self._texts.clear()
+        self.reset()
+
+    def reset(self):
+        self._blob = None
+        self.version += 1
+
+    def build(self):
+        self._keys = list(self._texts)
+        self._offsets.clear()
+        offset = 0
+        for key in self._keys:
+            self._offsets.append(offset)
+            offset += len(self._texts[key]) + 1
+        self._blob = self._SEPARATOR.join(self._texts[k] for k in self._keys)
+
+    def search(self, text):
+        """ Returns the list of keys with the texts containing the given text. """
+        text = text.upper().replace(self._SEPARATOR, "")
+        if not text:
+            return list(self._texts)
+
+        if self._blob is None:
+            self.build()
+
+        keys, offsets, find = self._keys, self._offsets, self._blob.find
+        found = []
+        pos = find(text)
+        while pos > -1:
+            index = bisect_right(offsets, pos) - 1
+            found.append(keys[index])
+            # Next text.
+            if index + 1 == len(offsets):
+                break
+            pos = find(text, offsets[index + 1])
+
+        return found
+
+
+class FacetIndex:
+    """ Sets of the keys by the values of the object fields [facets].
+
+        The sets are maintained incrementally, so filtering by several facets
+        is the intersection of the sets, and the facet counts are the sizes of the sets.
+    """
+
+    def __init__(self, **facets):
+        """ @param facets: facet names with the functions which return the facet value for the object. """
+        self._facets = facets
+        self._values = {name: defaultdict(set) for name in facets}
+        self.version = 0
+
+    def add(self, key, obj):
+        for name, get_value in self._facets.items():
+            self._values[name][get_value(obj)].add(key)
+        self.version += 1
+
+    def remove(self, key, obj):
+        for name, get_value in self._facets.items():
+            values, value = self._values[name], get_value(obj)
+            keys = values.get(value, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del values[value]
+        self.version += 1
+
+    def get(self, name, value):
+        return self._values[name].get(value, frozenset())
+
+    def get_count(self, name, value):
+        return len(self._values[name].get(value, ()))
+
+    def get_counts(self, name):
+        return {v: len(k) for v, k in self._values[name].items()}
+
+    def get_values(self, name):
+        return self._values[name].keys()
+
+    def select(self, **values):
+        """ Returns the set of keys matching all given facet values [None values are skipped].
+
+            Returns None if no values are given.
+        """
+        sets = sorted((self.get(n, v) for n, v in values.items() if v is not None), key=len)
+        if sets:
+            return sets[0].intersection(*sets[1:])
+
+    def clear(self):
+        for values in self._values.values():
+            values.clear()
+        self.version += 1
+
+
+class ModelIndex:
+    """ Text index of the string columns of the model rows [shared by the search providers].
+
+        The texts of the changed rows are updated on the fly.
+        Insertion, deletion and reordering of the rows lead to rebuilding on the next search.
+    """
+    _INSTANCES = WeakKeyDictionary()
+
+    def __init__(self, model):
+        self._columns = [c for c in range(model.get_n_columns()) if model.get_column_type(c) == GObject.TYPE_STRING]
+        self._index = TextIndex()
+        self._valid = False
+        model.connect("row-changed", self.on_row_changed)
+        model.connect("row-inserted", self.on_structure_changed)
+        model.connect("row-deleted", self.on_structure_changed)
+        model.connect("rows-reordered", self.on_structure_changed)
+
+    @classmethod
+    def get_instance(cls, model):
+        index = cls._INSTANCES.get(model, None)
+        if not index:
+            index = ModelIndex(model)
+            cls._INSTANCES[model] = index
+        return index
+
+    def on_row_changed(self, model, path, itr):
+        if self._valid:
+            self._index[path.to_string()] = self.get_text(model, itr)
+
+    def on_structure_changed(self, model, *args):
+        self._valid = False
+
+    def get_text(self, model, itr):
+        return "\t".join(v for v in model.get(itr, *self._columns) if v) if self._columns else ""
+
+    def build(self, model):
+        self._index.clear()
+
+        def add(mod, path, itr):
+            self._index[path.to_string()] = self.get_text(mod, itr)
+
+        model.foreach(add)
+        self._valid = True
+
+    def search(self, model, text):
+        """ Returns the list of paths [in the model order] of the rows containing the given text. """
+        if not self._valid:
+            self.build(model)
+        return [Gtk.TreePath.new_from_string(p) for p in self._index.search(text)]
 
 
 class SearchProvider:
@@ -7,6 +199,8 @@ class SearchProvider:
         self._current_index = -1
         self._max_indexes = 0
         self._views = views
+        # Keeps the current indexed models of the views [and so their indexes] alive.
+        self._models = {}
         self._up_button = up_button
         self._down_button = down_button
 
@@ -17,24 +211,40 @@ class SearchProvider:
             model = view.get_model()
             selection = view.get_selection()
             selection.unselect_all()
-            if not text:
+            if not text or model is None:
                 continue
 
-            text = text.upper()
-            for r in model:
-                if text in str(r[:]).upper():
-                    path = r.path
-                    selection.select_path(r.path)
-                    self._paths.append((view, path))
+            for path in self.get_paths(view, model, text):
+                if path.get_depth() == 1 or view.row_expanded(Gtk.TreePath(path.get_indices()[:-1])):
+                    selection.select_path(path)
+                self._paths.append((view, path))
 
         self._max_indexes = len(self._paths) - 1
-        if self._max_indexes > 0:
+        if self._max_indexes > -1:
             self.on_search_down()
 
         self.update_navigation_buttons()
 
+    def get_paths(self, view, model, text):
+        """ Returns the sorted list of paths of the model [including filter and sort wrappers]. """
+        models = [model]
+        while hasattr(models[-1], "get_model"):
+            models.append(models[-1].get_model())
+
+        base_model = models.pop()
+        self._models[view] = base_model
+        paths = ModelIndex.get_instance(base_model).search(base_model, text)
+        if not models:
+            return paths
+
+        for mod in reversed(models):
+            paths = [p for p in map(mod.convert_child_path_to_path, paths) if p]
+        return sorted(paths, key=Gtk.TreePath.get_indices)
+
     def scroll_to(self, index):
         view, path = self._paths[index]
+        if path.get_depth() > 1:
+            view.expand_to_path(path)
         view.scroll_to_cell(path, None)
         self.update_navigation_buttons()
 
@@ -426,16 +426,13 @@ class ServiceDetailsDialog:
 
     def update_bouquets(self, fav_id, old_fav_id):
         self._services.pop(old_fav_id, None)
-        for bq in self._bouquets.values():
-            indexes = []
-            for i, f_id in enumerate(bq):
-                if old_fav_id == f_id:
-                    indexes.append(i)
-            for i in indexes:
-                bq[i] = fav_id
+        self._bouquets.replace(old_fav_id, fav_id)
 
     @run_idle
     def update_fav_view(self, old_service, new_service):
+        if not self._bouquets.get_bouquets(new_service.fav_id):
+            return
+
         model = self._fav_view.get_model()
         for row in filter(lambda r: old_service.fav_id == r[7], model):
             model.set(row.iter, {1: new_service.coded,
@@ -0,0 +1,253 @@
+""" Persistent cache of the picons thumbnails.
+
+    Thumbnails of the one directory and size are stored as raw pixel buffers
+    in a single packed file with a separate index [JSON].
+    Index entries are invalidated by the mtime and size of the source file.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+from gi.repository import GdkPixbuf, GLib
+
+from app.commons import log, run_task
+from app.settings import HOME_PATH
+
+CACHE_PATH = HOME_PATH + "/.cache/demon-editor/thumbnails/"
+
+_INDEX_VERSION = 1
+# Max number of the pixbufs kept in memory by the Thumbnails.
+_THUMBNAILS_SIZE = 500
+# mtime [ns], size, offset, length, width, height, rowstride, has alpha
+_MTIME, _SIZE, _OFFSET, _LENGTH, _WIDTH, _HEIGHT, _ROWSTRIDE, _ALPHA = range(8)
+
+
+class ThumbnailsCache:
+    """ Persistent cache of the scaled pixbufs for the files of the one directory. """
+
+    _INSTANCES = {}
+    _INSTANCES_LOCK = Lock()
+
+    def __init__(self, path, width, height, cache_path=CACHE_PATH):
+        self._path = path if path.endswith(os.sep) else path + os.sep
+        self._width = width
+        self._height = height
+        self._lock = Lock()
+        self._modified = False
+        self._pack = None
+
+        name = "{}_{}x{}".format(hashlib.sha1(self._path.encode()).hexdigest(), width, height)
+        self._base_path = cache_path + name
+        self._index_path = "{}.idx".format(self._base_path)
+        # The pack is rewritten to a new file [generation] on compaction.
+        self._generation = 0
+        self._index = self.load_index()
+
+    @property
+    def pack_path(self):
+        return "{}.{}.pack".format(self._base_path, self._generation)
+
+    @classmethod
+    def get_instance(cls, path, width, height):
+        key = (path.rstrip(os.sep), width, height)
+        with cls._INSTANCES_LOCK:
+            instance = cls._INSTANCES.get(key)
+            if not instance:
+                instance = ThumbnailsCache(path, width, height)
+                cls._INSTANCES[key] = instance
+            return instance
+
+    @classmethod
+    def save_all(cls):
+        with cls._INSTANCES_LOCK:
+            instances = list(cls._INSTANCES.values())
+        for instance in instances:
+            instance.save()
+
+    def get(self, name):
+        """ Returns a pixbuf for the file with the given name or None. """
+        try:
+            stat = os.stat(self._path + name)
+        except OSError:
+            return
+
+        with self._lock:
+            entry = self._index.get(name)
+            if entry and entry[_MTIME] == stat.st_mtime_ns and entry[_SIZE] == stat.st_size:
+                pixbuf = self.read(entry)
+                if pixbuf:
+                    return pixbuf
+
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(self._path + name, self._width, self._height, True)
+        except GLib.GError:
+            return
+
+        self.write(name, stat, pixbuf)
+        return pixbuf
+
+    def read(self, entry):
+        try:
+            if not self._pack:
+                self._pack = open(self.pack_path, "rb")
+            self._pack.seek(entry[_OFFSET])
+            data = self._pack.read(entry[_LENGTH])
+        except OSError as e:
+            log("Thumbnails cache read error: {}".format(e))
+            return
+
+        if len(data) == entry[_LENGTH]:
+            return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data), GdkPixbuf.Colorspace.RGB, entry[_ALPHA], 8,
+                                                   entry[_WIDTH], entry[_HEIGHT], entry[_ROWSTRIDE])
+
+    def write(self, name, stat, pixbuf):
+        data = pixbuf.read_pixel_bytes().get_data()
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.pack_path), exist_ok=True)
+                with open(self.pack_path, "ab") as f:
+                    offset = f.tell()
+                    f.write(data)
+            except OSError as e:
+                log("Thumbnails cache write error: {}".format(e))
+            else:
+                self._index[name] = [stat.st_mtime_ns, stat.st_size, offset, len(data), pixbuf.get_width(),
+                                     pixbuf.get_height(), pixbuf.get_rowstride(), pixbuf.get_has_alpha()]
+                self._modified = True
+
+    def load_index(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        self._generation = index.get("generation", 0)
+        if index.get("version") != _INDEX_VERSION or not os.path.isfile(self.pack_path):
+            return {}
+        # Entries beyond the end of the pack [e.g. after an incomplete write] are dropped.
+        size = os.path.getsize(self.pack_path)
+        return {k: v for k, v in index.get("entries", {}).items() if v[_OFFSET] + v[_LENGTH] <= size}
+
+    def save(self):
+        """ Saves the index [via a temporary file]. Removes obsolete data from the pack if needed. """
+        with self._lock:
+            if not self._modified:
+                return
+
+            self.close()
+            try:
+                old_pack = self.compact()
+                with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", dir=os.path.dirname(self._index_path),
+                                                 delete=False) as f:
+                    json.dump({"version": _INDEX_VERSION, "generation": self._generation, "entries": self._index}, f)
+                os.replace(f.name, self._index_path)
+                if old_pack:
+                    os.remove(old_pack)
+            except OSError as e:
+                log("Thumbnails cache save error: {}".format(e))
+            else:
+                self._modified = False
+
+    def compact(self):
+        """ Rewrites the pack if more than half of it is occupied by obsolete data.
+
+            Returns the path of the old pack [to be removed after saving the index] or None.
+        """
+        old_pack = self.pack_path
+        size = os.path.getsize(old_pack)
+        used = sum(e[_LENGTH] for e in self._index.values())
+        if used * 2 >= size:
+            return
+
+        index = {k: list(v) for k, v in self._index.items()}
+        new_pack = "{}.{}.pack".format(self._base_path, self._generation + 1)
+        with open(old_pack, "rb") as src, open(new_pack, "wb") as dst:
+            offset = 0
+            for entry in sorted(index.values(), key=lambda e: e[_OFFSET]):
+                src.seek(entry[_OFFSET])
+                dst.write(src.read(entry[_LENGTH]))
+                entry[_OFFSET] = offset
+                offset += entry[_LENGTH]
+
+        self._index = index
+        self._generation += 1
+        return old_pack
+
+    def close(self):
+        if self._pack:
+            self._pack.close()
+            self._pack = None
+
+
+class Thumbnails:
+    """ Access to the thumbnails of the given size by the full paths of the files.
+
+        The recently used pixbufs are kept in memory [LRU].
+    """
+
+    def __init__(self, width, height, max_size=_THUMBNAILS_SIZE):
+        self._width = width
+        self._height = height
+        self._max_size = max_size
+        self._pixbufs = OrderedDict()
+        self._lock = Lock()
+        # The latest prefetch request [paths] for the single background worker.
+        self._prefetch_request = None
+        self._prefetching = False
+
+    def get(self, path, default=None):
+        with self._lock:
+            pixbuf = self._pixbufs.get(path)
+            if pixbuf:
+                self._pixbufs.move_to_end(path)
+                return pixbuf
+
+        dir_name, name = os.path.split(path)
+        pixbuf = ThumbnailsCache.get_instance(dir_name, self._width, self._height).get(name)
+        if not pixbuf:
+            return default
+
+        with self._lock:
+            self._pixbufs[path] = pixbuf
+            if len(self._pixbufs) > self._max_size:
+                self._pixbufs.popitem(last=False)
+        return pixbuf
+
+    def remove(self, path):
+        """ Removes the pixbuf from memory [e.g. after the file has been changed]. """
+        with self._lock:
+            self._pixbufs.pop(path, None)
+
+    def prefetch(self, paths):
+        """ Decodes the given files in the background.
+
+            The requests are handled by one worker. A pending request is replaced by the newer one.
+        """
+        with self._lock:
+            self._prefetch_request = paths
+            if self._prefetching:
+                return
+            self._prefetching = True
+        self.run_prefetch()
+
+    @run_task
+    def run_prefetch(self):
+        while True:
+            with self._lock:
+                paths, self._prefetch_request = self._prefetch_request, None
+                if paths is None:
+                    self._prefetching = False
+                    return
+
+            for path in paths:
+                if self._prefetch_request is not None:
+                    break  # The range is outdated.
+                self.get(path)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from threading import Event
+
+from app.settings import SettingsType
+from app.tools.picons import PiconsParser, PiconIds, Provider, convert_to
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data")
+
+
+class PiconsParserTest(unittest.TestCase):
+    """ Parsing of the saved provider page [logos with relative, root-relative and absolute links]. """
+
+    def setUp(self):
+        with open(os.path.join(DATA_PATH, "lyngsat_package.html"), encoding="utf-8") as f:
+            self.html = f.read()
+        self.provider = Provider(logo=None, name="Test Package", pos="19.2E",
+                                 url="https://www.lyngsat.com/packages/Test-Package.html",
+                                 on_id="1", ssid=None, single=False, selected=True)
+
+    def test_logo_urls(self):
+        picons = PiconsParser.parse(self.html, self.provider, PiconIds(), SettingsType.ENIGMA_2)
+        self.assertEqual(picons, {"https://www.lyngsat.com/logo/tv/aa/a_tv_de.png": "a_tv_de.png",
+                                  "https://www.lyngsat.com/logo/tv/bb/b_tv_de.png": "b_tv_de.png",
+                                  "https://www.lyngsat.com/logo/tv/cc/c_tv_at.png": "c_tv_at.png",
+                                  "https://www.lyngsat.com/logo/tv/dd/d_tv_de.png": "d_tv_de.png"})
+
+    def test_picon_names(self):
+        picon_id = "1_0_1_3039_1_1_C00000_0_0_0.png"
+        picon_ids = PiconIds()
+        picon_ids.add(picon_id, "1:0:1:3039:1:1:C00000:0:0:0:")
+        picons = PiconsParser.parse(self.html, self.provider, picon_ids, SettingsType.ENIGMA_2)
+        self.assertEqual(picons["https://www.lyngsat.com/logo/tv/aa/a_tv_de.png"], picon_id)
+
+
+class PiconIdsTest(unittest.TestCase):
+
+    def test_shared_key(self):
+        """ Services with the same (ssid, onid, namespace) and the different transponder ids. """
+        first, second = "1_0_1_3039_1_1_C00000_0_0_0.png", "1_0_1_3039_2_1_C00000_0_0_0.png"
+        picon_ids = PiconIds()
+        picon_ids.add(first, "1:0:1:3039:1:1:C00000:0:0:0:")
+        picon_ids.add(second, "1:0:1:3039:2:1:C00000:0:0:0:")
+        key = (0x3039, 1, 0xC00000)
+
+        picon_ids.remove(second, "1:0:1:3039:2:1:C00000:0:0:0:")
+        self.assertEqual(picon_ids.get(key), first)
+        picon_ids.remove(first, "1:0:1:3039:1:1:C00000:0:0:0:")
+        self.assertIsNone(picon_ids.get(key))
+
+
+class ConvertTest(unittest.TestCase):
+
+    def test_shared_destination(self):
+        """ Picons of the services with the type 1 and 19 have the same Neutrino file. """
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dest:
+            for name in ("1_0_1_3039_1_1_C00000_0_0_0.png", "1_0_19_3039_1_1_C00000_0_0_0.png"):
+                with open(os.path.join(src, name), "wb") as f:
+                    f.write(name.encode())
+
+            messages, done = [], Event()
+            convert_to(src, dest, SettingsType.ENIGMA_2, messages.append, done.set)
+            self.assertTrue(done.wait(5))
+            self.assertEqual(os.listdir(dest), ["100013039.png"])
+            self.assertIn("Converted: 1\n", messages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import http.server
+import threading
+import unittest
+
+from app.tools.streams import StreamsChecker
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # path -> (status, content type, body)
+    ROUTES = {"/ok": (200, "video/mp2t", (b"\x47" + b"\x00" * 187) * 4),
+              "/missing": (404, "text/html", b"<html>Not found</html>"),
+              "/forbidden": (403, "text/html", b"<html>Forbidden</html>"),
+              "/radio": (200, "audio/mpeg", b"\xff\xfb\x90\x64" * 64),
+              "/manifest.mpd": (200, "application/dash+xml", b"<?xml version='1.0'?><MPD></MPD>"),
+              "/page": (200, "text/html; charset=utf-8", b"<!DOCTYPE html><html>Login</html>")}
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, with_body):
+        status, content_type, body = self.ROUTES.get(self.path, (404, "text/html", b""))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamsCheckerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StreamsChecker.clear_cache()
+
+    def test_cache(self):
+        checker = StreamsChecker()
+        checker.check([self.url + "/ok", self.url + "/missing", "http://127.0.0.1:1/refused"])
+        cached = {k[0]: v for k, v in StreamsChecker._CACHE.items()}
+        self.assertEqual(cached[self.url + "/ok"][1], 600)
+        self.assertEqual(cached[self.url + "/missing"][1], 30)
+        # The errors without the response are not cached.
+        self.assertNotIn("http://127.0.0.1:1/refused", cached)
+        # The TTL of the reader is respected.
+        self.assertIsNone(StreamsChecker(ttl=0).get_cached(self.url + "/ok"))
+
+    def test_deep_check(self):
+        results = {r.url[len(self.url):]: r for r in StreamsChecker(deep=True).check(
+            self.url + p for p in ("/ok", "/radio", "/manifest.mpd", "/page", "/forbidden"))}
+        self.assertEqual({p for p, r in results.items() if r.available}, {"/ok", "/radio", "/manifest.mpd"})
+
+
+if __name__ == "__main__":
+    unittest.main()